@@ -5,27 +5,287 @@
 # HexChat 2.9.6
 
 __module_name__ = "Anti Massive Highlight"
-__module_version__ = "1.1"
+__module_version__ = "1.6.2"
 __module_description__ = "Hides messages that contain lots of nicknames."
 
+from collections import OrderedDict
+import os
+import re
+import sys
+import time
+
 import hexchat
 
+# Make imports work (see https://github.com/hexchat/hexchat/issues/1396)
+addons_path = os.path.join(hexchat.get_info("configdir"), "addons")
+if addons_path not in sys.path:
+    sys.path.append(addons_path)
+
+from pluginpref import JSONPluginPref  # noqa: E402
+from util import rfc_lower  # noqa: E402
+from util.channels import ChannelIndex  # noqa: E402
+from util.hookstats import HookStats  # noqa: E402
+
+SPAM_CACHE_SIZE = 256  # number of remembered spam messages
+SPAM_CACHE_TTL = 2 * 60  # in seconds
+SPAM_FINGERPRINT_MIN_LENGTH = 16  # shorter messages (without nicks) are not remembered
+FLOOD_MAX_KEYS = 4096  # number of hostmasks and channels tracked per rule
+PLAYBACK_AGE = 60  # messages older than this (in seconds) are backlog playback
+
+# Rate limits as [count, seconds] or None (off); messages are blocked
+# when `count` is reached within `seconds`.
+# Can be overridden per network with the /AMH command.
+DEFAULT_RATES = {
+    # highlights by the same user@host
+    'host_highlights': [10, 60],
+    # highlights by anyone in a channel;
+    # off by default because replies in busy channels trip it
+    'channel_highlights': None,
+    # messages by the same user@host;
+    # off by default because relay bots send whole channels through one host
+    'host_messages': None,
+}
+
+HELP_STR = """Usage:
+/AMH \002RATES\002 [<network>] - Show rate limits
+/AMH \002SET\002 <rule> <count> <seconds> [<network>] - Block when count is reached within seconds
+/AMH \002SET\002 <rule> off [<network>] - Disable a rule
+/AMH \002RESET\002 <rule> [<network>] - Restore the default for a rule
+Rules: """ + ", ".join(sorted(DEFAULT_RATES))
+
+prefs = JSONPluginPref(__module_name__)
+
+channel_index = ChannelIndex()
+
+# Matches runs of characters allowed in nicks,
+# so that "nick:" and "nick," are recognized.
+nick_re = re.compile(r"[\w\[\]\\`^{|}-]+")
+
+
+def count_highlights(text, users, limit):
+    """Count distinct nicks of `users` in `text`, stopping at `limit`."""
+    highlights = set()
+    for match in nick_re.finditer(text):
+        folded = rfc_lower(match.group(0))
+        if folded in users:
+            highlights.add(folded)
+            if len(highlights) >= limit:
+                break
+    return len(highlights)
+
+
+def make_fingerprint(text, users):
+    """Normalize a message by lowercasing it and removing the nicks of `users`."""
+    return " ".join(token for token in nick_re.findall(rfc_lower(text))
+                    if token not in users)
+
+
+class SpamCache(object):
+    """Size-bounded cache of fingerprints of recent spam messages.
+
+    Spam bots post the same message to many channels,
+    highlighting each channel's users.
+    Remembering the message without the nicks
+    allows dropping the copies with a single lookup.
+    """
+
+    def __init__(self, max_size=SPAM_CACHE_SIZE, ttl=SPAM_CACHE_TTL):
+        super(SpamCache, self).__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._d = OrderedDict()  # fingerprint -> expiry time, ordered by expiry
+
+    def _expire(self):
+        now = time.time()
+        while self._d and next(iter(self._d.values())) < now:
+            self._d.popitem(last=False)
+
+    def __bool__(self):
+        self._expire()
+        return bool(self._d)
+
+    def __contains__(self, fingerprint):
+        if fingerprint in self._d:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, fingerprint):
+        if len(fingerprint) < SPAM_FINGERPRINT_MIN_LENGTH:
+            return
+        self._d.pop(fingerprint, None)
+        self._d[fingerprint] = time.time() + self.ttl
+        while len(self._d) > self.max_size:
+            self._d.popitem(last=False)
+
+    def counters(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._d),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': "{:.1%}".format(self.hits / lookups if lookups else 0),
+        }
+
+
+spam_cache = SpamCache()
+
+
+class RateWindow(object):
+    """Ring buffer of the timestamps of the last `count` events."""
+
+    __slots__ = ('times', 'index')
+
+    def __init__(self, count):
+        self.times = [0.0] * count
+        self.index = 0
+
+    def hit(self, now, seconds, weight=1):
+        """Record `weight` events and return whether `count` were reached within `seconds`."""
+        times = self.times
+        for _ in range(min(weight, len(times))):
+            times[self.index] = now
+            self.index = (self.index + 1) % len(times)
+        # the oldest timestamp is at the current index
+        return times[self.index] > now - seconds
+
+
+class FloodDetector(object):
+    """Sliding-window rate limit for an arbitrary number of keys.
+
+    Memory is bounded by tracking at most `FLOOD_MAX_KEYS` keys,
+    dropping the least recently seen ones.
+    """
+
+    def __init__(self, count, seconds, max_keys=FLOOD_MAX_KEYS):
+        super(FloodDetector, self).__init__()
+        self.count = count
+        self.seconds = seconds
+        self.max_keys = max_keys
+        self._windows = OrderedDict()
+
+    def hit(self, key, weight=1, now=None):
+        if now is None:
+            now = time.time()
+        window = self._windows.get(key)
+        if window is None:
+            window = self._windows[key] = RateWindow(self.count)
+            if len(self._windows) > self.max_keys:
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(key)
+        return window.hit(now, self.seconds, weight)
+
+
+# (network, rule) -> FloodDetector or None
+detectors = {}
+
+
+def get_rate(network, rule):
+    rates = prefs.get('rates', {})
+    for key in (network, 'default'):
+        if rule in rates.get(key, {}):
+            return rates[key][rule]
+    return DEFAULT_RATES[rule]
+
+
+def get_detector(network, rule):
+    try:
+        return detectors[(network, rule)]
+    except KeyError:
+        rate = get_rate(network, rule)
+        detector = detectors[(network, rule)] = FloodDetector(*rate) if rate else None
+        return detector
+
+
+def check_rates(network, host, channel, highlights, now):
+    """Record a message sent at `now` and return whether it exceeds any rate limit."""
+    flooding = False
+    for rule, key, weight in (('host_messages', host, 1),
+                              ('host_highlights', host, highlights),
+                              ('channel_highlights', channel, highlights)):
+        detector = get_detector(network, rule)
+        if detector and weight:
+            flooding |= detector.hit(key, weight, now)
+    return flooding
+
 
 def privmsg(word, word_eol, userdata, attrs):
-    ctx = hexchat.get_context()
-    users = ctx.get_list('users')
-    nicks = {user.nick.lower() for user in users}
-    words = {w.lower() for w in word_eol[3][1:].split()}
-    highlights = nicks & words
-    nick, *_ = word[0][1:].partition("!")
-
-    if len(highlights) >= 5:
+    nick, _, host = word[0][1:].partition("!")
+    text = word_eol[3][1:]
+    users = channel_index.users()
+
+    fingerprint = None
+    if spam_cache:
+        fingerprint = make_fingerprint(text, users)
+        if fingerprint in spam_cache:
+            return hexchat.EAT_ALL
+
+    # Recent freenode spammers sometimes have less than 5 highlights,
+    # but they all have three digits at the end of their nicks.
+    limit = 3 if nick[-3:].isdigit() else 5
+
+    highlights = count_highlights(text, users, limit)
+    if highlights >= limit:
+        if fingerprint is None:
+            fingerprint = make_fingerprint(text, users)
+        spam_cache.add(fingerprint)
         return hexchat.EAT_ALL
-    elif len(highlights) >= 3 and nick[-3:].isdigit():
-        # Recent freenode spammers sometimes have less than 5 highlights,
-        # but they all have three digits at the end of their nicks.
+
+    # Backlog playback (e.g. from ZNC) replays old messages in a burst
+    now = time.time()
+    sent = attrs.time or now
+    if sent < now - PLAYBACK_AGE:
+        return hexchat.EAT_NONE
+
+    if check_rates(hexchat.get_info('network'), host, rfc_lower(word[2]), highlights, sent):
         return hexchat.EAT_ALL
     return hexchat.EAT_NONE
 
 
-hexchat.hook_server_attrs('PRIVMSG', privmsg)
+def amhcmd_cb(word, word_eol, userdata):
+    sub_cmd = word[1].lower() if len(word) > 1 else None
+    args = word[2:]
+    rates = prefs.get('rates', {})
+
+    if sub_cmd == 'rates' and len(args) <= 1:
+        network = args[0] if args else hexchat.get_info('network')
+        print("Rate limits for {}:".format(network))
+        for rule in sorted(DEFAULT_RATES):
+            rate = get_rate(network, rule)
+            print("  {}: {}".format(rule, "{} in {}s".format(*rate) if rate else "off"))
+        return hexchat.EAT_ALL
+
+    elif sub_cmd == 'set' and len(args) in (2, 3, 4) and args[0] in DEFAULT_RATES:
+        rule = args[0]
+        if args[1].lower() == 'off' and len(args) <= 3:
+            rate, network = None, args[2] if len(args) > 2 else 'default'
+        elif len(args) >= 3 and args[1].isdigit() and args[2].isdigit() and int(args[1]) > 0:
+            rate, network = [int(args[1]), int(args[2])], args[3] if len(args) > 3 else 'default'
+        else:
+            print(HELP_STR)
+            return hexchat.EAT_ALL
+        rates.setdefault(network, {})[rule] = rate
+        print("Set {} for {}".format(rule, network))
+
+    elif sub_cmd == 'reset' and len(args) in (1, 2) and args[0] in DEFAULT_RATES:
+        rule, network = args[0], args[1] if len(args) > 1 else 'default'
+        rates.get(network, {}).pop(rule, None)
+        print("Reset {} for {}".format(rule, network))
+
+    else:
+        print(HELP_STR)
+        return hexchat.EAT_ALL
+
+    prefs['rates'] = rates
+    detectors.clear()
+    return hexchat.EAT_ALL
+
+
+hook_stats = HookStats(__module_name__)
+hook_stats.hook_server_attrs('PRIVMSG', privmsg)
+hook_stats.hook_command('AMH', amhcmd_cb, help=HELP_STR)
+hook_stats.add_counters("spam cache", spam_cache.counters)
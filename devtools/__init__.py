@@ -0,0 +1,13 @@
+"""Tools for developing the addons in this repository outside of HexChat.
+
+These are not addons and need not be installed.
+
+Modules:
+
+- fakehexchat: offline stand-in for the `hexchat` module
+- bench: replays IRC traffic through addons and reports their throughput
+- bench_entries: measures the bytes per entry of smart_filter's maps
+- bench_find_ids: measures how fast youtube_title finds video ids in messages
+- bench_pluginpref: compares the serializers of the pluginpref module
+- test_youtube_title: tests youtube_title against a local stand-in for the API
+"""
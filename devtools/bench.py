@@ -0,0 +1,193 @@
+"""Replay IRC traffic through addons and report their throughput.
+
+Usage: python -m devtools.bench [-n EVENTS] [-a ADDON,...] [TRACE]
+
+TRACE is a file with one raw IRC line per line,
+as received from the server.
+Channels that are referenced in the trace
+are joined before replaying it,
+so the trace doesn't need to contain your own joins.
+Without a trace,
+a synthetic one with large channels, chatter, joins, parts, quits,
+netsplits, nick changes and mode changes is generated.
+
+Every addon is loaded on its own into a fresh `fakehexchat` state.
+The `(none)` row replays the trace without any addon
+and is the baseline of the stand-in itself.
+Reported are events per second
+and the net amount of memory allocated per event,
+measured with tracemalloc in a separate pass.
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import os
+import random
+import runpy
+import sys
+import time
+import tracemalloc
+
+from . import fakehexchat
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ADDONS = ('smart_filter', 'amh', 'discord_bot_bridge', 'ff_twitch', 'better_raw_modes')
+
+# addons that only act on certain servers
+SERVERS = {
+    'ff_twitch': "tmi.twitch.tv",
+}
+
+NICK = "me"
+TIMER_INTERVAL = 1000  # run due timers every this many events
+
+
+def generate_trace(events, seed=0, channels=4, users=2000):
+    """Generate setup lines and a list of events with a plausible distribution."""
+    rand = random.Random(seed)
+    channel_names = ["#bench%d" % i for i in range(channels)] + ["#nanaone"]
+    members = {}
+    setup = []
+    next_user = 0
+
+    def new_user():
+        nonlocal next_user
+        next_user += 1
+        return "user%05d" % next_user
+
+    for name in channel_names:
+        members[name] = [new_user() for _ in range(users)]
+        setup.append(":%s!%s@bench.host JOIN %s" % (NICK, NICK, name))
+        for i in range(0, users, 100):
+            names = " ".join(rand.choice(("", "", "", "+", "@")) + nick
+                             for nick in members[name][i:i + 100])
+            setup.append(":irc.example.net 353 %s = %s :%s" % (NICK, name, names))
+        setup.append(":irc.example.net 366 %s %s :End of /NAMES list." % (NICK, name))
+    members["#nanaone"].append("_dc_1")
+
+    words = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod".split()
+    lines = []
+    while len(lines) < events:
+        channel = rand.choice(channel_names)
+        nicks = members[channel]
+        nick = rand.choice(nicks)
+        source = ":%s!%s@bench.host" % (nick, nick)
+        roll = rand.random()
+        if roll < 0.50:
+            text = " ".join(rand.choice(words) for _ in range(rand.randint(3, 15)))
+            if rand.random() < 0.1:
+                text = rand.choice(nicks) + ": " + text
+            if rand.random() < 0.01:
+                text = " ".join(rand.sample(nicks, 8))
+            if channel == "#nanaone" and rand.random() < 0.3:
+                source, text = ":_dc_1!bot@bench.host", "<Some One> " + text
+            lines.append("%s PRIVMSG %s :%s" % (source, channel, text))
+        elif roll < 0.62:
+            joiner = new_user()
+            nicks.append(joiner)
+            lines.append(":%s!%s@bench.host JOIN %s" % (joiner, joiner, channel))
+        elif roll < 0.72:
+            nicks.remove(nick)
+            lines.append("%s PART %s :bye" % (source, channel))
+        elif roll < 0.80:
+            for other in members.values():
+                if nick in other:
+                    other.remove(nick)
+            reason = "irc.example.net hub.example.net" if rand.random() < 0.5 else "Quit: bye"
+            lines.append("%s QUIT :%s" % (source, reason))
+        elif roll < 0.85:
+            new_nick = new_user()
+            for other in members.values():
+                if nick in other:
+                    other[other.index(nick)] = new_nick
+            lines.append("%s NICK :%s" % (source, new_nick))
+        else:
+            targets = rand.sample(nicks, 3)
+            modes = rand.choice(("+ooo", "-vvv", "+ovb", "+ovv"))
+            if "b" in modes:
+                targets[-1] = "*!*@spam.host"
+            lines.append(":op!op@bench.host MODE %s %s %s" % (channel, modes, " ".join(targets)))
+    return setup, lines
+
+
+def read_trace(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        lines = [line.rstrip("\r\n") for line in f if line.strip()]
+
+    channels = []
+    for line in lines:
+        for param in line.split()[2:4]:
+            param = param.lstrip(":")
+            if param.startswith("#") and param not in channels:
+                channels.append(param)
+    setup = [":%s!%s@bench.host JOIN %s" % (NICK, NICK, name) for name in channels]
+    return setup, lines
+
+
+def load(addon, setup):
+    fakehexchat.reset(nick=NICK, server=SERVERS.get(addon, "irc.example.net"))
+    if addon is not None:
+        runpy.run_path(os.path.join(ROOT, addon + ".py"), run_name='__main__')
+    for line in setup:
+        fakehexchat.recv(line)
+    fakehexchat.run_timers(force=True)
+
+
+def replay(events):
+    for i, line in enumerate(events):
+        fakehexchat.recv(line)
+        if not i % TIMER_INTERVAL:
+            fakehexchat.run_timers()
+
+
+def bench(addon, setup, events):
+    with contextlib.redirect_stdout(io.StringIO()):
+        load(addon, setup)
+        gc.collect()
+        start = time.perf_counter()
+        replay(events)
+        elapsed = time.perf_counter() - start
+
+        load(addon, setup)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        replay(events)
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        fakehexchat.unload()
+
+    return len(events) / elapsed, (after - before) / len(events)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m devtools.bench",
+                                     description="Replay IRC traffic through addons.")
+    parser.add_argument('trace', nargs='?', help="file with raw IRC lines")
+    parser.add_argument('-n', '--events', type=int, default=50000,
+                        help="number of synthetic events (default: %(default)s)")
+    parser.add_argument('-a', '--addons', default=",".join(ADDONS),
+                        help="comma-separated addons to benchmark (default: all)")
+    args = parser.parse_args(argv)
+
+    fakehexchat.install()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    if args.trace:
+        setup, events = read_trace(args.trace)
+    else:
+        setup, events = generate_trace(args.events)
+
+    print("{:<20} {:>12} {:>14}".format("addon", "events/s", "net B/event"))
+    for addon in [None] + args.addons.split(","):
+        rate, allocated = bench(addon, setup, events)
+        print("{:<20} {:>12.0f} {:>14.1f}".format(addon or "(none)", rate, allocated))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Measure the memory used per entry of smart_filter's maps.
+
+Usage: python -m devtools.bench_entries [-n ENTRIES] [-c CHANNELS]
+
+Fills a TimestampMap and a JoinMap
+with entries spread over a number of channels
+and reports the bytes allocated per entry,
+measured with tracemalloc.
+Nicks and join arguments are created beforehand
+because hexchat holds them anyway.
+
+Exits with status 1 if an entry exceeds its target size in `TARGETS`.
+"""
+
+import argparse
+import gc
+import os
+import runpy
+import sys
+import tracemalloc
+
+from . import fakehexchat
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TARGETS = {  # bytes per entry
+    'TimestampMap': 144,
+    'JoinMap': 200,
+}
+
+
+def measure(fill, entries):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = fill()  # keep it alive until measured
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return (after - before) / entries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m devtools.bench_entries",
+                                     description="Measure smart_filter's bytes per entry.")
+    parser.add_argument('-n', '--entries', type=int, default=50000,
+                        help="number of entries (default: %(default)s)")
+    parser.add_argument('-c', '--channels', type=int, default=20,
+                        help="number of channels (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    fakehexchat.install()
+    fakehexchat.reset()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    smart_filter = runpy.run_path(os.path.join(ROOT, "smart_filter.py"))
+
+    server = "irc.example.net"
+    channels = ["#bench%d" % i for i in range(args.channels)]
+    users = [(channels[i % args.channels], "user%06d" % i) for i in range(args.entries)]
+    words = {nick: ["%s!%s@bench.host" % (nick, nick), channel, nick + "@bench.host"]
+                    for channel, nick in users}
+
+    def fill_tmap():
+        tmap = smart_filter['TimestampMap']()
+        for i, (channel, nick) in enumerate(users):
+            tmap.add(nick, float(i), server=server, channel=channel)
+        return tmap
+
+    def fill_jmap():
+        jmap = smart_filter['JoinMap']()
+        for i, (channel, nick) in enumerate(users):
+            jmap.add(nick, float(i), tuple(words[nick][1:]), server=server, channel=channel)
+        return jmap
+
+    failed = False
+    print("{:<14} {:>12} {:>8}".format("map", "B/entry", "target"))
+    for name, fill in (('TimestampMap', fill_tmap), ('JoinMap', fill_jmap)):
+        per_entry = measure(fill, args.entries)
+        failed |= per_entry > TARGETS[name]
+        print("{:<14} {:>12.1f} {:>8}".format(name, per_entry, TARGETS[name]))
+
+    fakehexchat.unload()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
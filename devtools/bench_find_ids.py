@@ -0,0 +1,107 @@
+"""Measure how fast youtube_title finds video ids in chat messages.
+
+Usage: python -m devtools.bench_find_ids [-n MESSAGES] [CORPUS]
+
+CORPUS is a file with one chat message per line.
+Without a corpus,
+a synthetic one is generated
+where few messages contain links
+and fewer of those are YouTube links.
+
+Compares `find_ids` against the previous implementation,
+which ran two regular expressions over every message
+and sorted their combined matches.
+Host names are matched case-insensitively by both.
+"""
+
+import argparse
+import os
+import random
+import re
+import runpy
+import sys
+import timeit
+
+from . import fakehexchat
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+normal = re.compile(r"(?:&|\?|/)v(?:=|/)([\w\-]{11})")
+short = re.compile(r"(?:(?:https?\://)?(?:\w+\.)?(?:youtube|youtu)(?:\.\w+){1,2}/)([\w\-]{11})",
+                   re.IGNORECASE)
+
+
+def find_ids_reference(text):
+    ids = set()
+
+    for reg in (normal, short):
+        for m in reg.finditer(text):
+            ids.add((m.start(1), m.group(1)))
+
+    return [vid for (pos, vid) in sorted(ids, key=lambda x: x[0])]
+
+
+def generate_corpus(messages, seed=0):
+    rand = random.Random(seed)
+    words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+             "tempor incididunt ut labore et dolore magna aliqua").split()
+    chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+    links = (
+        "https://www.youtube.com/watch?v={}",
+        "https://youtu.be/{}",
+        "https://www.youtube.com/watch?v={}&t=42s",
+        "https://m.youtube.com/watch?feature=share&v={}",
+        "https://www.YouTube.com/watch?v={}",
+        "HTTPS://YOUTU.BE/{}",
+        "https://github.com/hexchat/hexchat/issues/1396",
+        "https://example.com/index.php?page=2",
+        "https://en.wikipedia.org/wiki/Internet_Relay_Chat",
+    )
+
+    corpus = []
+    for _ in range(messages):
+        text = [rand.choice(words) for _ in range(rand.randint(3, 20))]
+        roll = rand.random()
+        if roll < 0.05:
+            link = rand.choice(links).format("".join(rand.choice(chars) for _ in range(11)))
+            text.insert(rand.randrange(len(text) + 1), link)
+        corpus.append(" ".join(text))
+    return corpus
+
+
+def read_corpus(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return [line.rstrip("\r\n") for line in f if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m devtools.bench_find_ids",
+                                     description="Measure youtube_title.find_ids.")
+    parser.add_argument('corpus', nargs='?', help="file with one chat message per line")
+    parser.add_argument('-n', '--messages', type=int, default=100000,
+                        help="number of synthetic messages (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    fakehexchat.install()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    find_ids = runpy.run_path(os.path.join(ROOT, "youtube_title.py"))['find_ids']
+
+    if args.corpus:
+        corpus = read_corpus(args.corpus)
+    else:
+        corpus = generate_corpus(args.messages)
+
+    for text in corpus:
+        if find_ids(text) != list(dict.fromkeys(find_ids_reference(text))):
+            print("Results differ for {!r}".format(text))
+
+    print("{:<20} {:>14}".format("implementation", "messages/s"))
+    for name, func in (("reference", find_ids_reference), ("find_ids", find_ids)):
+        elapsed = min(timeit.repeat(lambda: list(map(func, corpus)), number=1, repeat=5))
+        print("{:<20} {:>14.0f}".format(name, len(corpus) / elapsed))
+
+
+if __name__ == '__main__':
+    main()
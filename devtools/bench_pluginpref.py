@@ -0,0 +1,56 @@
+"""Compare the serializers of the pluginpref module.
+
+Usage: python -m devtools.bench_pluginpref [-n ITEMS]
+
+Reports the time to serialize and deserialize
+a few kinds of numeric-heavy settings
+and the length of the stored strings
+for JSONPluginPref and every backend of BinaryPluginPref.
+"""
+
+import argparse
+import random
+import timeit
+
+from . import fakehexchat
+
+
+def generate_values(items, seed=0):
+    rand = random.Random(seed)
+    return {
+        'small ints': [rand.randrange(100) for _ in range(items)],
+        'timestamps': [1700000000 + rand.randrange(10 ** 7) for _ in range(items)],
+        'floats': [rand.random() for _ in range(items)],
+        'nick stats': {"nick%d" % i: [rand.randrange(1000), 1700000000 + rand.randrange(10 ** 7)]
+                       for i in range(items // 2)},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m devtools.bench_pluginpref",
+                                     description="Compare pluginpref serializers.")
+    parser.add_argument('-n', '--items', type=int, default=1000,
+                        help="number of items per value (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    fakehexchat.install()
+    from pluginpref import BinaryPluginPref, JSONPluginPref
+
+    serializers = [("json", JSONPluginPref("bench"))]
+    serializers += [(backend, BinaryPluginPref("bench", backend=backend))
+                    for backend in BinaryPluginPref.backends]
+
+    print("{:<12} {:<8} {:>12} {:>12} {:>10}"
+          .format("value", "backend", "encode us", "decode us", "length"))
+    for name, value in generate_values(args.items).items():
+        for backend, prefs in serializers:
+            stored = prefs.serialize(value)
+            assert prefs.deserialize(stored) == value
+            encode = min(timeit.repeat(lambda: prefs.serialize(value), number=100, repeat=5))
+            decode = min(timeit.repeat(lambda: prefs.deserialize(stored), number=100, repeat=5))
+            print("{:<12} {:<8} {:>12.1f} {:>12.1f} {:>10}"
+                  .format(name, backend, encode * 10 ** 4, decode * 10 ** 4, len(stored)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,633 @@
+"""Offline stand-in for hexchat's Python plugin API.
+
+Implements enough of the `hexchat` module
+to load and exercise the addons in this repository outside of HexChat,
+e.g. for benchmarks.
+Incoming IRC traffic is simulated with `recv`,
+which runs server hooks, updates channel and user lists
+and emits the print events HexChat would emit.
+
+Only a single server connection is simulated.
+Timers are run explicitly through `run_timers`.
+
+Usage:
+
+>>> from devtools import fakehexchat
+>>> fakehexchat.install()  # registers as `hexchat` in `sys.modules`
+>>> fakehexchat.reset(nick="me", server="irc.example.net")
+>>> runpy.run_path("smart_filter.py", run_name="__main__")
+>>> fakehexchat.recv(":me!user@host JOIN #channel")
+>>> fakehexchat.recv(":nick!user@host PRIVMSG #channel :hello")
+>>> fakehexchat.output[-1]
+'nick\thello'
+"""
+
+from collections import deque
+import re
+import sys
+import tempfile
+import time as _time
+from types import SimpleNamespace
+
+
+EAT_NONE = 0
+EAT_HEXCHAT = 1
+EAT_PLUGIN = 2
+EAT_ALL = EAT_HEXCHAT | EAT_PLUGIN
+
+PRI_HIGHEST = 127
+PRI_HIGH = 64
+PRI_NORM = 0
+PRI_LOW = -64
+PRI_LOWEST = -128
+
+EVENT_TEXT = {
+    'Channel Action': "*$t$1 $2",
+    'Channel Action Hilight': "*$t$1 $2",
+    'Channel Message': "$1$t$2",
+    'Channel Msg Hilight': "$1$t$2",
+    'Change Nick': "*$t$1 is now known as $2",
+    'Join': "*$t$1 ($3) has joined",
+    'Kick': "*$t$1 has kicked $2 from $3 ($4)",
+    'Notice': "-$1-$t$2",
+    'Part': "*$t$1 ($2) has left",
+    'Part with Reason': "*$t$1 ($2) has left ($4)",
+    'Private Message': "$1$t$2",
+    'Quit': "*$t$1 has quit ($2)",
+    'Raw Modes': "*$t$1 sets mode $2",
+    'You Join': "*$tNow talking on $2",
+    'Your Message': "$1$t$2",
+}
+
+DEFAULT_PREFS = {
+    'irc_logging': 0,
+    'irc_logmask': "%n/%c.log",
+    'irc_raw_modes': 1,
+    'stamp_log_format': "%b %d %H:%M:%S ",
+}
+
+_rfc_lower_table = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\^",
+    "abcdefghijklmnopqrstuvwxyz{}|~",
+)
+_strip_re = re.compile(r"\003(?:\d{1,2}(?:,\d{1,2})?)?|[\002\017\026\035\037]")
+
+# lines printed to any context (bounded, for inspection)
+output = deque(maxlen=1000)
+# commands issued through `command`
+commands = deque(maxlen=1000)
+
+_state = None
+
+
+###############################################################################
+# Simulated client state
+
+class Hook(object):
+    __slots__ = ('kind', 'name', 'callback', 'userdata', 'priority', 'interval', 'due')
+
+    def __init__(self, kind, name, callback, userdata, priority=PRI_NORM, interval=None):
+        self.kind = kind
+        self.name = name
+        self.callback = callback
+        self.userdata = userdata
+        self.priority = priority
+        self.interval = interval
+        self.due = None if interval is None else _time.monotonic() + interval / 1000
+
+
+class Attributes(object):
+    __slots__ = ('time',)
+
+    def __init__(self, time=0):
+        self.time = time
+
+
+class Channel(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.users = {}  # casefolded nick -> user list item
+
+
+class State(object):
+
+    def __init__(self, nick, server, network, configdir, tempdir=None):
+        self.nick = nick
+        self.server = server
+        self.network = network
+        self.configdir = configdir
+        self.tempdir = tempdir  # TemporaryDirectory backing configdir, if any
+        self.nickmodes = "qaohv"
+        self.nickprefixes = "~&@%+"
+        self.chanmodes = "beI,k,l,imnpst"
+        self.channels = {}  # casefolded name -> Channel
+        self.hooks = {}  # (kind, name) -> [Hook]
+        self.timers = []
+        self.unload_hooks = []
+        self.prefs = dict(DEFAULT_PREFS)
+        self.pluginprefs = {}
+        self.server_context = Context(None)
+        self.context = self.server_context
+
+
+class Context(object):
+    """A channel (or the server tab, if `channel` is None)."""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def __eq__(self, other):
+        return isinstance(other, Context) and rfc_lower(self.channel or "") == rfc_lower(other.channel or "")
+
+    def __hash__(self):
+        return hash(rfc_lower(self.channel or ""))
+
+    def __repr__(self):
+        return "Context(%r)" % self.channel
+
+    def _with(self, func, *args, **kwargs):
+        previous, _state.context = _state.context, self
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _state.context = previous
+
+    def get_info(self, name):
+        return self._with(get_info, name)
+
+    def get_list(self, name):
+        return self._with(get_list, name)
+
+    def prnt(self, text):
+        return self._with(prnt, text)
+
+    def emit_print(self, event_name, *args, **kwargs):
+        return self._with(emit_print, event_name, *args, **kwargs)
+
+    def command(self, text):
+        return self._with(command, text)
+
+    def set(self):
+        _state.context = self
+
+
+def install():
+    """Register this module as `hexchat` and initialize the state."""
+    sys.modules['hexchat'] = sys.modules[__name__]
+    if _state is None:
+        reset()
+
+
+def reset(nick="me", server="irc.example.net", network="ExampleNet", configdir=None):
+    """Forget all hooks, channels and preferences.
+
+    Without `configdir`,
+    a temporary directory is used
+    that is removed by `unload` or the next `reset`.
+    """
+    global _state
+    _cleanup()
+    tempdir = None
+    if configdir is None:
+        tempdir = tempfile.TemporaryDirectory(prefix="fakehexchat-")
+        configdir = tempdir.name
+    _state = State(nick, server, network, configdir, tempdir)
+    output.clear()
+    commands.clear()
+
+
+def unload():
+    """Run and remove the unload hooks, then remove the temporary configdir."""
+    for hook in _state.unload_hooks:
+        hook.callback(hook.userdata)
+    _state.unload_hooks = []
+    _cleanup()
+
+
+def _cleanup():
+    if _state is not None and _state.tempdir is not None:
+        _state.tempdir.cleanup()
+        _state.tempdir = None
+
+
+def run_timers(force=False):
+    """Run due timers (or all, if `force`) and reschedule those returning True."""
+    now = _time.monotonic()
+    for hook in list(_state.timers):
+        if hook not in _state.timers or not (force or hook.due <= now):
+            continue
+        if hook.callback(hook.userdata):
+            hook.due = now + hook.interval / 1000
+        elif hook in _state.timers:
+            _state.timers.remove(hook)
+
+
+###############################################################################
+# hexchat API
+
+def get_info(name):
+    context = _state.context
+    if name == 'channel':
+        return context.channel or _state.network
+    elif name == 'server':
+        return _state.server
+    elif name == 'host':
+        return _state.server
+    elif name == 'network':
+        return _state.network
+    elif name == 'nick':
+        return _state.nick
+    elif name == 'configdir':
+        return _state.configdir
+    elif name == 'version':
+        return "2.16.1"
+    elif name.startswith("event_text "):
+        return EVENT_TEXT.get(name[len("event_text "):], "$1$t$2")
+    return None
+
+
+def get_prefs(name):
+    return _state.prefs.get(name)
+
+
+def get_context():
+    return _state.context
+
+
+def find_context(server=None, channel=None):
+    if server is not None and server != _state.server:
+        return None
+    if channel is None:
+        return _state.server_context
+    if rfc_lower(channel) in _state.channels:
+        return Context(channel)
+    return None
+
+
+def get_list(name):
+    if name == 'channels':
+        items = [SimpleNamespace(channel=_state.network, server=_state.server, network=_state.network,
+                                 type=1, users=0, context=_state.server_context,
+                                 nickmodes=_state.nickmodes, nickprefixes=_state.nickprefixes,
+                                 chanmodes=_state.chanmodes, flags=0, id=1, lag=0, queue=0)]
+        for channel in _state.channels.values():
+            items.append(SimpleNamespace(channel=channel.name, server=_state.server,
+                                         network=_state.network, type=2,
+                                         users=len(channel.users), context=Context(channel.name),
+                                         nickmodes=_state.nickmodes,
+                                         nickprefixes=_state.nickprefixes,
+                                         chanmodes=_state.chanmodes, flags=0, id=1, lag=0, queue=0))
+        return items
+    elif name == 'users':
+        channel = _get_channel(_state.context.channel)
+        return list(channel.users.values()) if channel else []
+    elif name in ('notify', 'dcc', 'ignore'):
+        return []
+    return None
+
+
+def nickcmp(nick1, nick2):
+    nick1, nick2 = rfc_lower(nick1), rfc_lower(nick2)
+    return (nick1 > nick2) - (nick1 < nick2)
+
+
+def strip(text, length=-1, flags=3):
+    return _strip_re.sub("", text if length < 0 else text[:length])
+
+
+def prnt(text):
+    output.append(text)
+
+
+def command(text):
+    commands.append(text)
+    word = text.split()
+    if word and _dispatch('command', word[0].upper(), [word, _word_eol(word)], None):
+        return
+    cmd, _, args = text.partition(" ")
+    cmd = cmd.upper()
+    if cmd == 'RECV':
+        recv(args)
+    elif cmd in ('SAY', 'MSG') and _state.context.channel:
+        emit_print('Your Message', _state.nick, args)
+
+
+def emit_print(event_name, *args, time=0):
+    word = [str(arg) for arg in args]
+    eat = _dispatch('print', event_name, [word, _word_eol(word)], Attributes(time))
+    if not eat & EAT_HEXCHAT:
+        fmt = EVENT_TEXT.get(event_name, "$1$t$2")
+        text = re.sub(r"\$(\d)", lambda m: word[int(m.group(1)) - 1]
+                      if int(m.group(1)) <= len(word) else "", fmt).replace("$t", "\t")
+        output.append(text)
+    return True
+
+
+def _add_hook(kind, name, callback, userdata, priority):
+    hook = Hook(kind, name.upper() if kind == 'server' else name, callback, userdata, priority)
+    hooks = _state.hooks.setdefault((kind, hook.name), [])
+    hooks.append(hook)
+    hooks.sort(key=lambda hook: -hook.priority)
+    return hook
+
+
+def hook_print(name, callback, userdata=None, priority=PRI_NORM):
+    return _add_hook('print', name, callback, userdata, priority)
+
+
+def hook_print_attrs(name, callback, userdata=None, priority=PRI_NORM):
+    return _add_hook('print_attrs', name, callback, userdata, priority)
+
+
+def hook_server(name, callback, userdata=None, priority=PRI_NORM):
+    return _add_hook('server', name, callback, userdata, priority)
+
+
+def hook_server_attrs(name, callback, userdata=None, priority=PRI_NORM):
+    return _add_hook('server_attrs', name, callback, userdata, priority)
+
+
+def hook_command(name, callback, userdata=None, priority=PRI_NORM, help=None):
+    return _add_hook('command', name.upper(), callback, userdata, priority)
+
+
+def hook_timer(timeout, callback, userdata=None):
+    hook = Hook('timer', None, callback, userdata, interval=timeout)
+    _state.timers.append(hook)
+    return hook
+
+
+def hook_unload(callback, userdata=None):
+    hook = Hook('unload', None, callback, userdata)
+    _state.unload_hooks.append(hook)
+    return hook
+
+
+def unhook(hook):
+    if hook in _state.timers:
+        _state.timers.remove(hook)
+    elif hook in _state.unload_hooks:
+        _state.unload_hooks.remove(hook)
+    else:
+        for hooks in _state.hooks.values():
+            if hook in hooks:
+                hooks.remove(hook)
+
+
+def get_pluginpref(name):
+    value = _state.pluginprefs.get(name)
+    if value is None:
+        return None
+    # mirrors the Python plugin's and hexchat_pluginpref_get_int's guessing
+    value = value[:511]
+    if len(value) > 12:
+        return value
+    match = re.match(r"\s*[+-]?\d+", value)
+    number = int(match.group(0)) if match else 0
+    if number == 0 and not value.startswith("0"):
+        number = -1
+    if number == -1 and value != "-1":
+        return value
+    return number
+
+
+def set_pluginpref(name, value):
+    if isinstance(value, bool):
+        value = int(value)
+    if isinstance(value, (str, int)):
+        _state.pluginprefs[name] = str(value)
+        return True
+    return False
+
+
+def del_pluginpref(name):
+    _state.pluginprefs.pop(name, None)
+    return True
+
+
+def list_pluginpref():
+    return list(_state.pluginprefs)
+
+
+###############################################################################
+# Simulated server traffic
+
+def rfc_lower(text):
+    return text.translate(_rfc_lower_table)
+
+
+def _word_eol(word):
+    return [" ".join(word[i:]) for i in range(len(word))]
+
+
+def _dispatch(kind, name, args, attrs):
+    """Call hooks of `kind` and `kind + '_attrs'`, returning the combined eat value."""
+    hooks = _state.hooks.get((kind, name), []) + _state.hooks.get((kind + '_attrs', name), [])
+    if len(hooks) > 1:
+        hooks.sort(key=lambda hook: -hook.priority)
+    eat = EAT_NONE
+    for hook in hooks:
+        if hook.kind.endswith('_attrs'):
+            result = hook.callback(*args, hook.userdata, attrs)
+        else:
+            result = hook.callback(*args, hook.userdata)
+        eat |= result or EAT_NONE
+        if eat & EAT_PLUGIN:
+            break
+    return eat
+
+
+def _get_channel(name):
+    return name and _state.channels.get(rfc_lower(name))
+
+
+def _is_you(nick):
+    return nickcmp(nick, _state.nick) == 0
+
+
+def _make_user(nick, host="", prefix=""):
+    return SimpleNamespace(nick=nick, host=host, prefix=prefix, account=None, away=0,
+                           lasttalk=0, realname="", selected=0)
+
+
+def _emit_in(channel, event_name, *args, time=0):
+    Context(channel).emit_print(event_name, *args, time=time)
+
+
+def recv(line, time=0):
+    """Simulate receiving a raw IRC line from the server."""
+    word = line.split()
+    if not word:
+        return
+    if not word[0].startswith(":"):
+        word.insert(0, ":" + _state.server)
+    command_name = word[1].upper()
+
+    # Server hooks run in the context of the targeted channel, if any
+    channel = len(word) > 2 and _get_channel(word[2].lstrip(":"))
+    context = Context(channel.name) if channel else _state.server_context
+    eat = context._with(_dispatch, 'server', command_name, [word, _word_eol(word)],
+                        Attributes(time))
+    if eat & EAT_HEXCHAT:
+        return
+
+    source = word[0][1:]
+    nick, _, host = source.partition("!")
+    params = word[2:]
+    for i, param in enumerate(params):
+        if param.startswith(":"):
+            params[i:] = [" ".join(params[i:])[1:]]
+            break
+
+    handler = _HANDLERS.get(command_name)
+    if handler:
+        handler(nick, host, params, time)
+
+
+def _on_join(nick, host, params, time):
+    name = params[0]
+    if _is_you(nick):
+        channel = _state.channels[rfc_lower(name)] = Channel(name)
+        channel.users[rfc_lower(nick)] = _make_user(nick, host)
+        _emit_in(name, 'You Join', nick, name, host, time=time)
+        return
+    channel = _get_channel(name)
+    if channel:
+        channel.users[rfc_lower(nick)] = _make_user(nick, host)
+        _emit_in(name, 'Join', nick, name, host, time=time)
+
+
+def _on_part(nick, host, params, time):
+    name = params[0]
+    channel = _get_channel(name)
+    if not channel:
+        return
+    reason = params[1] if len(params) > 1 else ""
+    if _is_you(nick):
+        _emit_in(name, 'You Part', nick, host, name, reason, time=time)
+        del _state.channels[rfc_lower(name)]
+        return
+    if reason:
+        _emit_in(name, 'Part with Reason', nick, host, name, reason, time=time)
+    else:
+        _emit_in(name, 'Part', nick, host, name, time=time)
+    channel.users.pop(rfc_lower(nick), None)
+
+
+def _on_kick(nick, host, params, time):
+    name, target = params[0], params[1]
+    channel = _get_channel(name)
+    if not channel:
+        return
+    _emit_in(name, 'Kick', nick, target, name, params[2] if len(params) > 2 else "", time=time)
+    if _is_you(target):
+        del _state.channels[rfc_lower(name)]
+    else:
+        channel.users.pop(rfc_lower(target), None)
+
+
+def _on_quit(nick, host, params, time):
+    folded = rfc_lower(nick)
+    for channel in list(_state.channels.values()):
+        if folded in channel.users:
+            _emit_in(channel.name, 'Quit', nick, params[0] if params else "", host, time=time)
+            channel.users.pop(folded, None)
+
+
+def _on_nick(nick, host, params, time):
+    new_nick = params[0]
+    folded = rfc_lower(nick)
+    if _is_you(nick):
+        _state.nick = new_nick
+    for channel in _state.channels.values():
+        user = channel.users.pop(folded, None)
+        if user is not None:
+            user.nick = new_nick
+            channel.users[rfc_lower(new_nick)] = user
+            _emit_in(channel.name, 'Change Nick', nick, new_nick, time=time)
+
+
+def _on_privmsg(nick, host, params, time, notice=False):
+    target, text = params[0], params[1] if len(params) > 1 else ""
+    channel = _get_channel(target)
+    if notice:
+        _emit_in(channel and channel.name, 'Notice', nick, text, time=time)
+        return
+    if not channel:
+        _emit_in(None, 'Private Message', nick, text, time=time)
+        return
+
+    user = channel.users.get(rfc_lower(nick))
+    mode = user.prefix if user else ""
+    hilight = rfc_lower(_state.nick) in rfc_lower(text)
+    if text.startswith("\001ACTION ") and text.endswith("\001"):
+        event = 'Channel Action Hilight' if hilight else 'Channel Action'
+        _emit_in(channel.name, event, nick, text[8:-1], mode, time=time)
+    else:
+        event = 'Channel Msg Hilight' if hilight else 'Channel Message'
+        _emit_in(channel.name, event, nick, text, mode, time=time)
+
+
+def _on_notice(nick, host, params, time):
+    _on_privmsg(nick, host, params, time, notice=True)
+
+
+def _on_mode(nick, host, params, time):
+    target, *modes = params
+    channel = _get_channel(target)
+    if not channel:
+        return
+
+    args = iter(modes[1:])
+    chanmodes = (_state.chanmodes.split(",") + ["", "", "", ""])[:4]
+    action = "+"
+    for char in modes[0] if modes else "":
+        if char in "+-":
+            action = char
+        elif char in _state.nickmodes:
+            user = channel.users.get(rfc_lower(next(args, "")))
+            if user is not None:
+                prefix = _state.nickprefixes[_state.nickmodes.index(char)]
+                user.prefix = prefix if action == "+" else ""
+        elif char in chanmodes[0] + chanmodes[1] or (char in chanmodes[2] and action == "+"):
+            next(args, None)
+
+    _emit_in(channel.name, 'Raw Modes', nick, " ".join(params), time=time)
+
+
+def _on_isupport(nick, host, params, time):
+    for token in params[1:]:
+        key, _, value = token.partition("=")
+        if key == 'PREFIX':
+            match = re.match(r"\((\w*)\)(.*)", value)
+            if match:
+                _state.nickmodes, _state.nickprefixes = match.groups()
+        elif key == 'CHANMODES':
+            _state.chanmodes = value
+
+
+def _on_names(nick, host, params, time):
+    # :server 353 <nick> <type> <channel> :[prefix]nick ...
+    channel = _get_channel(params[2])
+    if not channel:
+        return
+    for name in params[3].split():
+        prefix = name[0] if name[0] in _state.nickprefixes else ""
+        name = name[len(prefix):]
+        name, _, host = name.partition("!")  # userhost-in-names
+        channel.users[rfc_lower(name)] = _make_user(name, host, prefix)
+
+
+_HANDLERS = {
+    'JOIN': _on_join,
+    'PART': _on_part,
+    'KICK': _on_kick,
+    'QUIT': _on_quit,
+    'NICK': _on_nick,
+    'PRIVMSG': _on_privmsg,
+    'NOTICE': _on_notice,
+    'MODE': _on_mode,
+    '005': _on_isupport,
+    '353': _on_names,
+}
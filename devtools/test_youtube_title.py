@@ -0,0 +1,177 @@
+"""Tests for youtube_title's link detection and API requests.
+
+Run using `python -m devtools.test_youtube_title`.
+
+Loads the addon into `fakehexchat`
+and points it at a stand-in for the YouTube API on 127.0.0.1,
+so no network access is needed.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import runpy
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+from . import fakehexchat
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TIMEOUT = 5  # in seconds; to wait for titles
+
+
+class APIServer(ThreadingHTTPServer):
+    """Stand-in for the videos API.
+
+    Responds with the statuses in `statuses` first, then with titles.
+    A status can be given as a `(status, headers)` tuple.
+    Ids starting with "missing" are not found.
+    """
+
+    def __init__(self, statuses=()):
+        super().__init__(('127.0.0.1', 0), APIHandler)
+        self.statuses = list(statuses)
+        self.requests = []  # (client port, path)
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_port
+
+
+class APIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections alive
+
+    def do_GET(self):
+        self.server.requests.append((self.client_address[1], self.path))
+        headers = {}
+        if self.server.statuses:
+            status, body = self.server.statuses.pop(0), {}
+            if isinstance(status, tuple):
+                status, headers = status
+        else:
+            ids = parse_qs(urlparse(self.path).query)['id'][0].split(",")
+            status, body = 200, {'items': [{'id': vid, 'snippet': {'title': "Title of " + vid}}
+                                           for vid in ids if not vid.startswith("missing")]}
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def load_addon(server):
+    """Load youtube_title and return its globals."""
+    fakehexchat.reset()
+    addon = runpy.run_path(os.path.join(ROOT, "youtube_title.py"), run_name='__main__')
+    # The returned dict is a copy, so patch the functions' globals
+    addon = addon['yt_api'].__globals__
+    addon['API_URL'] = server.url
+    fakehexchat.command("ytt key set testkey")
+    return addon
+
+
+def get_titles(*vids, timeout=TIMEOUT):
+    """Run `/ytt get` and wait for the printed titles."""
+    fakehexchat.output.clear()
+    fakehexchat.command("ytt get " + " ".join("https://youtu.be/" + vid for vid in vids))
+    fakehexchat.run_timers(force=True)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        lines = [line for line in fakehexchat.output if "Title:" in line]
+        if len(lines) >= len(vids):
+            return lines
+        time.sleep(0.01)
+        fakehexchat.run_timers()
+    raise AssertionError("timed out waiting for titles, got: %r" % list(fakehexchat.output))
+
+
+def test_retry():
+    with APIServer(statuses=[503]) as server:
+        addon = load_addon(server)
+
+        assert get_titles("aaaaaaaaaaa") == ["*ytt*\t\002Title:\002 Title of aaaaaaaaaaa"]
+        assert len(server.requests) == 2  # 503 and retry
+        assert get_titles("bbbbbbbbbbb") == ["*ytt*\t\002Title:\002 Title of bbbbbbbbbbb"]
+        assert len(server.requests) == 3
+        # all requests went over the same connection
+        assert len({port for port, path in server.requests}) == 1
+
+        counters = addon['api_stats'].counters()
+        assert counters['requests'] == 2
+        assert counters['errors'] == 1
+
+        fakehexchat.unload()
+    print("test_retry passed")
+
+
+def test_retry_after_capped():
+    with APIServer(statuses=[(429, {'Retry-After': "3600"})]) as server:
+        addon = load_addon(server)
+
+        start = time.monotonic()
+        assert get_titles("ddddddddddd") == ["*ytt*\t\002Title:\002 Title of ddddddddddd"]
+        assert time.monotonic() - start < addon['RETRY_WAIT_MAX'] + 1
+        assert len(server.requests) == 2
+
+        fakehexchat.unload()
+    print("test_retry_after_capped passed")
+
+
+def test_not_found_not_cached():
+    with APIServer() as server:
+        addon = load_addon(server)
+
+        for _ in range(2):
+            assert get_titles("missing0000") == ["*ytt*\t\002Title:\002 Video for missing0000 not found"]
+        assert len(server.requests) == 2
+        assert addon['cache'].get("missing0000") is None
+
+        get_titles("ccccccccccc")
+        get_titles("ccccccccccc")
+        assert len(server.requests) == 3
+
+        fakehexchat.unload()
+    print("test_not_found_not_cached passed")
+
+
+def test_find_ids():
+    fakehexchat.reset()
+    find_ids = runpy.run_path(os.path.join(ROOT, "youtube_title.py"))['find_ids']
+    assert find_ids("https://www.YouTube.com/watch?v=dQw4w9WgXcQ") == ["dQw4w9WgXcQ"]
+    assert find_ids("HTTPS://YOUTU.BE/dQw4w9WgXcQ and https://youtu.be/dQw4w9WgXcQ") \
+        == ["dQw4w9WgXcQ"]
+    assert find_ids("https://example.com/watch?v=dQw4w9WgXcQ") == []
+    print("test_find_ids passed")
+
+
+def main():
+    fakehexchat.install()
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    test_find_ids()
+    test_retry()
+    test_retry_after_capped()
+    test_not_found_not_cached()
+    print("all tests passed!")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,22 @@
 __module_name__ = "Discord Bot Bridge"
 __module_author__ = "FichteFoll"
-__module_version__ = "0.3.5"
+__module_version__ = "0.3.7"
 __module_description__ = "Translates messages bridged from Discord into the native IRC protocol"
 
+import os
 import re
+import sys
 
 import hexchat
 
+# Make imports work (see https://github.com/hexchat/hexchat/issues/1396)
+addons_path = os.path.join(hexchat.get_info("configdir"), "addons")
+if addons_path not in sys.path:
+    sys.path.append(addons_path)
+
+from util.channels import ChannelIndex  # noqa: E402
+from util.hookstats import HookStats  # noqa: E402
+
 # associates channels where this functionality is active with the nickname of the bot
 # using a case-insensitive regular expression
 BOT_MAP = {
@@ -18,6 +28,8 @@ MODE_CHAR = "⇔"
 REVERSE_COLOR = "\026"
 ITALICS = "\035"
 
+channel_index = ChannelIndex()
+
 
 def iter_fill(iterable, n, fillvalue=None):
     """Iterate over iterable and append fillvalue until n values have been yielded."""
@@ -30,10 +42,7 @@ def iter_fill(iterable, n, fillvalue=None):
 
 
 def is_user_in_channel(nick, context=hexchat):
-    for user in context.get_list('users'):
-        if hexchat.nickcmp(nick, user.nick) == 0:
-            return True
-    return False
+    return channel_index.get_user(nick, context) is not None
 
 
 def msg_cb(word, word_eol, event_name, attrs):
@@ -96,7 +105,7 @@ def my_msg_cb(word, word_eol, _):
     if channel not in BOT_MAP:
         return hexchat.EAT_NONE
 
-    discord_nicks = {user.nick for user in hexchat.get_list('users')
+    discord_nicks = {user.nick for user in channel_index.users().values()
                      if user.host == "someone@discord.server"}
     if not discord_nicks:
         return hexchat.EAT_NONE
@@ -113,10 +122,12 @@ def my_msg_cb(word, word_eol, _):
 
 
 if __name__ == '__main__':
+    hook_stats = HookStats(__module_name__)
+
     for event in ('Channel Message', 'Channel Msg Hilight',
                   'Channel Action', 'Channel Action Hilight'):
-        hexchat.hook_print_attrs(event, msg_cb, event, hexchat.PRI_HIGHEST)
+        hook_stats.hook_print_attrs(event, msg_cb, event, hexchat.PRI_HIGHEST)
 
-    hexchat.hook_command('', my_msg_cb)
+    hook_stats.hook_command('', my_msg_cb)
 
     print(__module_name__, __module_version__, "loaded")
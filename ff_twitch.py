@@ -22,13 +22,14 @@ if addons_path not in sys.path:
     sys.path.append(addons_path)
 
 from util import only_on, set_timeout  # noqa: E402
+from util.channels import ChannelIndex  # noqa: E402
 
 
 ###############################################################################
 
 __module_name__ = "My Twitch Enhancements"
 __module_author__ = "FichteFoll"
-__module_version__ = "0.4.3"
+__module_version__ = "0.4.4"
 __module_description__ = "Enhancements for Twitch.tv"
 
 # TODO make configurable
@@ -38,21 +39,14 @@ USER_THRESHOLD = 15
 # pre-build decorator
 twitch_only = only_on(servers=["twitch.tv"])
 
+# global
+channel_index = None
+
 
 @twitch_only
 def joinpart_cb(word, word_eol, event):
     """Block Join/Part events for channels with more than X users."""
-    curr_chan = hexchat.get_info('channel')
-    channel_list = None
-    for item in hexchat.get_list('channels'):
-        if item.channel == curr_chan:
-            channel_list = item
-            break
-    else:
-        print("can't find channel")
-        return hexchat.EAT_NONE
-
-    if channel_list.users > USER_THRESHOLD:
+    if channel_index.user_count() > USER_THRESHOLD:
         return hexchat.EAT_ALL
     else:
         return hexchat.EAT_NONE
@@ -99,6 +93,9 @@ def caps_cb(word, word_eol, userdata):
 
 
 def main():
+    global channel_index
+    channel_index = ChannelIndex()
+
     for evt in ('Join', 'Part'):  # 'Part with Reason' likely not necessary
         hexchat.hook_print(evt, joinpart_cb, evt, priority=hexchat.PRI_HIGH)
 
@@ -3,29 +3,60 @@
 Exported classes:
 
 - PluginPref
+- CachedPluginPref
 - SerializablePluginPref
 - JSONPluginPref
+- BinaryPluginPref
 """
 
 from abc import ABCMeta, abstractmethod
+import array
+import base64
 from collections.abc import MutableMapping
+from contextlib import contextmanager
 import json
+import marshal
+import pickle
+import re
+import sys
+import zlib
 
 import hexchat
 
 
-__version__ = "0.4.1"
+__version__ = "0.8.0"
 versioninfo = tuple(map(int, __version__.split(".")))
 __author__ = "FichteFoll <fichtefoll2@googlemail.com>"
 
 
 __all__ = (
     "PluginPref",
+    "CachedPluginPref",
     "SerializablePluginPref",
     "JSONPluginPref",
+    "BinaryPluginPref",
 )
 
 
+MAX_VALUE_LENGTH = 511  # hexchat reads values into a 512 byte buffer
+SHARD_SIZE = 500  # length of values that are split into shards
+SHARD_MARK = "~"
+shard_header_re = re.compile(r"~(z?)(\d+):(\d+)$")
+shard_name_re = re.compile(r"#\d+$")
+
+
+def _split_bytes(text, size):
+    """Split `text` into chunks of at most `size` bytes when encoded as UTF-8."""
+    chunks = []
+    while text:
+        chunk = text[:size]
+        while len(chunk.encode()) > size:
+            chunk = chunk[:-1]
+        chunks.append(chunk)
+        text = text[len(chunk):]
+    return chunks
+
+
 class PluginPref(MutableMapping):
     """MutableMapping interface for hexchat's pluginpref storage system.
 
@@ -74,9 +105,38 @@ class PluginPref(MutableMapping):
     >>> pref.delete("doesn't exist")
     >>> pref.get("doesn't exist", NotImplemented)
     NotImplemented
+
+    Listing keys requires hexchat to list all plugins' settings.
+    `items`, `clear`, `update_many` and `transaction`
+    do so at most once:
+
+    >>> pref.update_many({"a": 1, "b": 2})
+    >>> with pref.transaction() as data:
+    ...     data["a"] += 1
+    ...     del data["b"]
+    >>> pref.items()
+    [('a', 2)]
+    >>> pref.clear()
+
+
+    Sharded mode:
+
+    Strings longer than `MAX_VALUE_LENGTH` bytes are truncated by hexchat.
+    With `sharded=True`,
+    strings longer than `SHARD_SIZE` bytes are split
+    across the numbered keys `key#0`, `key#1`, ...
+    and the key itself holds a header with their number and checksum.
+    Shards are reassembled when the key is read
+    and only shards that changed are written.
+    With `compress=True`,
+    all strings are compressed with zlib, encoded as base64 and sharded.
+    Keys ending in `#` and a number are reserved in this mode.
+
+    >>> pref = PluginPref(__module_name__, sharded=True, compress=True)
+    >>> pref["history"] = " ".join(nicks)
     """
 
-    def __init__(self, name=None, prefix_sep=".", prefix=None):
+    def __init__(self, name=None, prefix_sep=".", prefix=None, sharded=False, compress=False):
         """Build a new mutable PluginPref mapping.
 
         Arguments determine the prefix,
@@ -92,12 +152,18 @@ class PluginPref(MutableMapping):
         and will override unification of the passed module name.
 
         prefix_sep is inserted between the prefix and key names (default '.').
+
+        sharded and compress enable sharded mode (see class documentation).
+        compress implies sharded.
         """
         if not (name or prefix):
             raise TypeError("name or prefix must be provided")
         self.prefix = prefix or name.strip().replace(" ", "_").lower().lstrip("_")
         self.prefix_sep = prefix_sep
+        self.sharded = sharded or compress
+        self.compress = compress
         self._version_pref_name = "_version.%s" % self.prefix
+        self._shard_cache = {}  # key -> (header, reassembled value)
 
     def __eq__(self, other):
         if not isinstance(other, PluginPref):
@@ -107,6 +173,9 @@ class PluginPref(MutableMapping):
     def _keyname(self, key=""):
         return self.prefix + self.prefix_sep + key
 
+    def _shardname(self, key, index):
+        return "%s#%d" % (self._keyname(key), index)
+
     def keys(self):
         """Return a set of all keys in this PluginPref instance."""
         shared_prefix = self._keyname()
@@ -115,6 +184,8 @@ class PluginPref(MutableMapping):
         for key in all_keys:
             if key.startswith(shared_prefix):
                 keys.add(key[len(shared_prefix):])
+        if self.sharded:
+            keys = {key for key in keys if not shard_name_re.search(key)}
         return keys
 
     def __contains__(self, key):
@@ -133,6 +204,8 @@ class PluginPref(MutableMapping):
         val = hexchat.get_pluginpref(self._keyname(key))
         if val is None:
             raise KeyError(key)
+        if self.sharded and isinstance(val, str) and val.startswith(SHARD_MARK):
+            val = self._read_shards(key, val)
         return val
 
     def __setitem__(self, key, value):
@@ -140,13 +213,19 @@ class PluginPref(MutableMapping):
             raise TypeError("Key must be a string")
         if value is None:
             raise ValueError("Can not set `None`")
+        if self.sharded:
+            if isinstance(value, str):
+                self._write_shards(key, value)
+                return
+            self._write_shards(key, None)
         if not hexchat.set_pluginpref(self._keyname(key), value):
             raise RuntimeError("Could not set %s" % value)
 
     def __delitem__(self, key):
         if not isinstance(key, str):
             raise TypeError("Key must be a string")
-        if key not in self:
+        # Cheaper than `key in self`
+        if hexchat.get_pluginpref(self._keyname(key)) is None:
             raise KeyError(key)
         else:
             self.delete(key)
@@ -156,9 +235,126 @@ class PluginPref(MutableMapping):
         """
         if not isinstance(key, str):
             raise TypeError("Key must be a string")
+        if self.sharded:
+            self._write_shards(key, None)
         if not hexchat.del_pluginpref(self._keyname(key)):
             raise RuntimeError("Could not delete %s" % key)
 
+    def _shard_count(self, header):
+        match = isinstance(header, str) and shard_header_re.match(header)
+        return int(match.group(2)) if match else 0
+
+    def _read_shards(self, key, header):
+        match = shard_header_re.match(header)
+        if not match:
+            return header  # not a header, but a string starting with SHARD_MARK
+
+        cached = self._shard_cache.get(key)
+        if cached is not None and cached[0] == header:
+            return cached[1]
+
+        compressed, count, checksum = match.group(1), int(match.group(2)), int(match.group(3))
+        shards = []
+        for index in range(count):
+            shard = hexchat.get_pluginpref(self._shardname(key, index))
+            if not isinstance(shard, str) or not shard.startswith(SHARD_MARK):
+                raise ValueError("Missing shard %d of %s" % (index, key))
+            shards.append(shard[len(SHARD_MARK):])
+        data = "".join(shards)
+        if zlib.crc32(data.encode()) != checksum:
+            raise ValueError("Checksum mismatch for %s" % key)
+        if compressed:
+            data = zlib.decompress(base64.b64decode(data)).decode()
+
+        self._shard_cache[key] = (header, data)
+        return data
+
+    def _write_shards(self, key, value):
+        """Store `value` in shards if required and remove obsolete shards.
+
+        Only writes shards that differ from the stored ones.
+        With `value` being `None`, only removes shards.
+        """
+        name = self._keyname(key)
+        old_header = hexchat.get_pluginpref(name)
+        old_count = self._shard_count(old_header)
+        self._shard_cache.pop(key, None)
+
+        if value is None:
+            shards, header = [], None
+        elif self.compress:
+            data = base64.b64encode(zlib.compress(value.encode())).decode('ascii')
+            shards = _split_bytes(data, SHARD_SIZE - len(SHARD_MARK))
+            header = "%sz%d:%d" % (SHARD_MARK, len(shards), zlib.crc32(data.encode()))
+        elif len(value.encode()) <= SHARD_SIZE and not value.startswith(SHARD_MARK):
+            shards, header = [], value
+        else:
+            shards = _split_bytes(value, SHARD_SIZE - len(SHARD_MARK))
+            header = "%s%d:%d" % (SHARD_MARK, len(shards), zlib.crc32(value.encode()))
+
+        for index, shard in enumerate(shards):
+            shard_name = self._shardname(key, index)
+            shard = SHARD_MARK + shard
+            if index >= old_count or hexchat.get_pluginpref(shard_name) != shard:
+                if not hexchat.set_pluginpref(shard_name, shard):
+                    raise RuntimeError("Could not set shard %d of %s" % (index, key))
+        for index in range(len(shards), old_count):
+            hexchat.del_pluginpref(self._shardname(key, index))
+
+        if header is not None and header != old_header:
+            if not hexchat.set_pluginpref(name, header):
+                raise RuntimeError("Could not set %s" % value)
+        if shards:
+            self._shard_cache[key] = (header, value)
+
+    def items(self):
+        """Return a list of all (key, value) pairs."""
+        return [(key, self[key]) for key in self.keys()]
+
+    def clear(self):
+        """Delete all keys."""
+        for key in self.keys():
+            self.delete(key)
+
+    def update_many(self, other=(), **kwargs):
+        """Like `update`, but only write values that are not already stored.
+
+        Accepts the same arguments as `dict.update`.
+        Only the given keys are read.
+        Values that can not be read are overwritten.
+        """
+        keys = self.keys()
+        for key, value in dict(other, **kwargs).items():
+            if key in keys:
+                try:
+                    if self._stored_form(self[key]) == self._stored_form(value):
+                        continue
+                except ValueError:
+                    pass
+            self[key] = value
+
+    @contextmanager
+    def transaction(self):
+        """Context manager providing all settings as a dict.
+
+        Changes to the dict are written back when the block exits
+        or discarded if it raises an exception.
+        Only changed keys are written or deleted.
+        """
+        data = dict(self.items())
+        original = {key: self._stored_form(value) for key, value in data.items()}
+        yield data
+
+        for key in original.keys() - data.keys():
+            self.delete(key)
+        for key, value in data.items():
+            if key not in original or original[key] != self._stored_form(value):
+                self[key] = value
+
+    def _stored_form(self, value):
+        """Return the form of `value` that `transaction` compares to detect changes."""
+        return value
+
     def get_version(self):
         """Retrieve the currently stored preferences' version.
 
@@ -224,6 +420,164 @@ class PluginPref(MutableMapping):
     )
 
 
+class CachedPluginPref(PluginPref):
+    """PluginPref that keeps its settings in memory and writes them back lazily.
+
+    All keys with the instance's prefix are loaded once on construction.
+    Reads are then served from memory
+    without calling into hexchat.
+    Changes are collected
+    and written back in one batch
+    `flush_interval` milliseconds after the first change,
+    when the plugin is unloaded
+    or when `flush` is called.
+    Hexchat rewrites its whole pluginpref file for every single change,
+    so batching is considerably cheaper for frequent changes.
+
+    Values that have not been flushed yet
+    are returned as they were set,
+    i.e. before hexchat converts booleans and digit strings to numbers.
+
+    Changes made to the same keys
+    by other means (including other instances)
+    are not seen until `reload` is called.
+    The timer and unload hooks belong to the plugin that creates the instance.
+
+    Can be combined with SerializablePluginPref subclasses:
+
+    >>> class CachedJSONPluginPref(JSONPluginPref, CachedPluginPref):
+    ...     pass
+    >>> pref = CachedJSONPluginPref(__module_name__)
+    >>> pref["a_list"] = [1, 2, 3]
+    >>> pref.flush()
+    """
+
+    def __init__(self, name=None, prefix_sep=".", prefix=None, flush_interval=5000, **kwargs):
+        """Build a new cached PluginPref mapping.
+
+        See `PluginPref.__init__` for the other arguments.
+
+        flush_interval is the delay in milliseconds
+        after which changes are written back.
+        If it is `None`,
+        changes are only written back on `flush` and on unload.
+        """
+        super(CachedPluginPref, self).__init__(name, prefix_sep, prefix, **kwargs)
+        self.flush_interval = flush_interval
+        self._values = {}
+        self._dirty = set()
+        self._timer = None
+        hexchat.hook_unload(self._unload_cb)
+        self.reload()
+
+    def reload(self):
+        """Load all settings from hexchat.
+
+        Changes that have not been flushed are discarded.
+        """
+        self._values = {key: super(CachedPluginPref, self).__getitem__(key)
+                        for key in super(CachedPluginPref, self).keys()}
+        self._dirty.clear()
+
+    def flush(self):
+        """Write all changed settings back to hexchat."""
+        if self._timer is not None:
+            hexchat.unhook(self._timer)
+            self._timer = None
+
+        for key in list(self._dirty):
+            if key in self._values:
+                super(CachedPluginPref, self).__setitem__(key, self._values[key])
+                # Read back what hexchat made of it
+                self._values[key] = super(CachedPluginPref, self).__getitem__(key)
+            else:
+                super(CachedPluginPref, self).delete(key)
+            # Keys that failed to be written stay dirty
+            self._dirty.discard(key)
+
+    @property
+    def dirty(self):
+        """Whether there are changes that have not been written back yet."""
+        return bool(self._dirty)
+
+    def _mark_dirty(self, key):
+        self._dirty.add(key)
+        if self._timer is None and self.flush_interval is not None:
+            self._timer = hexchat.hook_timer(self.flush_interval, self._timer_cb)
+
+    def _timer_cb(self, userdata):
+        self._timer = None  # hook is removed by returning False
+        self.flush()
+        return False
+
+    def _unload_cb(self, userdata):
+        self._timer = None
+        self.flush()
+
+    def keys(self):
+        return set(self._values)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(list(self._values))
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, key):
+        if not isinstance(key, str):
+            raise TypeError("Key must be a string")
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise TypeError("Key must be a string")
+        if value is None:
+            raise ValueError("Can not set `None`")
+        # Fail now rather than when flushing
+        if not isinstance(value, (str, int)):
+            raise RuntimeError("Could not set %s" % value)
+        self._values[key] = value
+        self._mark_dirty(key)
+
+    def __delitem__(self, key):
+        if not isinstance(key, str):
+            raise TypeError("Key must be a string")
+        del self._values[key]
+        self._mark_dirty(key)
+
+    def delete(self, key):
+        if not isinstance(key, str):
+            raise TypeError("Key must be a string")
+        if self._values.pop(key, None) is not None:
+            self._mark_dirty(key)
+
+
+IMMUTABLE_TYPES = (str, int, float, bool, type(None))
+
+
+def _copy_strategy(value):
+    """Return how a deserialized value can be handed out safely.
+
+    `None` if it is immutable,
+    `copy` if a shallow copy suffices
+    and `deserialize` if it must be deserialized again.
+    """
+    if isinstance(value, IMMUTABLE_TYPES):
+        return None
+    elif isinstance(value, list):
+        items = value
+    elif isinstance(value, dict):
+        items = value.values()
+    else:
+        return 'deserialize'
+    if all(isinstance(item, IMMUTABLE_TYPES) for item in items):
+        return 'copy'
+    return 'deserialize'
+
+
 class SerializablePluginPref(PluginPref, metaclass=ABCMeta):
     """Abstract base class for serializable interfaces on top of PluginPref.
 
@@ -232,7 +586,22 @@ class SerializablePluginPref(PluginPref, metaclass=ABCMeta):
     - deserialize(obj)
     which get called before writing to
     and after reading from PluginPref respectively.
+
+    Deserialized values are memoized per key
+    as long as the stored string does not change.
+    Every read returns a separate object,
+    so modifying it does not affect the memo.
+    Flat lists and dicts are copied,
+    nested ones are deserialized again
+    because that is faster than copying them in Python.
+    Assigning a value that serializes to the stored string
+    does not write anything.
     """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._memo = {}  # key -> (stored value, deserialized value, copy strategy)
+
     @abstractmethod
     def serialize(self, obj):
         """Serialize `obj` into another object."""
@@ -244,13 +613,41 @@ class SerializablePluginPref(PluginPref, metaclass=ABCMeta):
         return obj
 
     def __getitem__(self, key):
-        value = super().__getitem__(key)
-        return self.deserialize(value)
+        stored = super().__getitem__(key)
+        memo = self._memo.get(key)
+        if memo is None or memo[0] != stored:
+            value = self.deserialize(stored)
+            memo = self._memo[key] = (stored, value, _copy_strategy(value))
+
+        stored, value, strategy = memo
+        if strategy is None:
+            return value
+        elif strategy == 'copy':
+            return value.copy()
+        else:
+            return self.deserialize(stored)
 
     def __setitem__(self, key, value):
         value = self.serialize(value)
+        # Equal values may serialize differently, e.g. `[1]` and `[1.0]`
+        memo = self._memo.get(key)
+        if memo is not None and str(memo[0]) == value:
+            try:
+                unchanged = memo[0] == super().__getitem__(key)
+            except KeyError:
+                unchanged = False
+            if unchanged:
+                return
         super().__setitem__(key, value)
 
+    def delete(self, key):
+        self._memo.pop(key, None)
+        super().delete(key)
+
+    def _stored_form(self, value):
+        # Equal values may serialize differently, e.g. `[1]` and `[1.0]`
+        return self.serialize(value)
+
 
 class JSONPluginPref(SerializablePluginPref):
     """MutableMapping built on top of PluginPref with JSON serialization.
@@ -273,6 +670,11 @@ class JSONPluginPref(SerializablePluginPref):
 
     Usage of `super()` allows nesting of SerializablePluginPref subclasses
     other other interesting subclassing models.
+
+    Use sharded mode (see PluginPref) for large values:
+
+    >>> pref = JSONPluginPref(__module_name__, sharded=True)
+    >>> pref["history"] = {nick: list(range(100)) for nick in nicks}
     """
 
     def serialize(self, obj):
@@ -287,3 +689,110 @@ class JSONPluginPref(SerializablePluginPref):
             obj = str(obj)
         obj = super().deserialize(obj)
         return json.loads(obj)
+
+
+ARRAY_TYPECODES = ('b', 'h', 'i', 'q')  # signed integers of 1, 2, 4 and 8 bytes
+
+
+def _pack_array(obj):
+    """Return the typecode and bytes of a list of only ints or only floats, or `None`."""
+    if not isinstance(obj, list) or not obj:
+        return None
+    if all(type(item) is float for item in obj):
+        typecode = 'd'
+    elif all(type(item) is int for item in obj):
+        low, high = min(obj), max(obj)
+        for typecode in ARRAY_TYPECODES:
+            bits = array.array(typecode).itemsize * 8 - 1
+            if -(1 << bits) <= low and high < (1 << bits):
+                break
+        else:
+            return None
+    else:
+        return None
+
+    packed = array.array(typecode, obj)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return typecode, packed.tobytes()
+
+
+def _unpack_array(typecode, data):
+    packed = array.array(typecode)
+    packed.frombytes(data)
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tolist()
+
+
+class BinaryPluginPref(SerializablePluginPref):
+    """MutableMapping built on top of PluginPref with binary serialization.
+
+    More compact and faster than JSONPluginPref
+    for numeric data.
+    Values are serialized with the backend chosen per instance
+    and stored encoded with base64:
+
+    - 'marshal' (default): built-in types, including tuples, sets and bytes.
+      Its format may change between Python versions,
+      so values may become unreadable after upgrading Python.
+      Prefer another backend or JSONPluginPref for data that must be kept.
+    - 'pickle': arbitrary picklable objects, using protocol 5.
+      Unpickling can execute code,
+      so only use it for settings you wrote yourself.
+    - 'array': lists of only ints or only floats
+      are packed with the array module,
+      anything else falls back to marshal.
+
+    Stored values are tagged with their backend,
+    so values stored with a different backend can still be read.
+
+    Sharded mode (see PluginPref) is enabled by default
+    because encoded values easily exceed `MAX_VALUE_LENGTH`.
+    Without it, such values are refused.
+
+    Raises `ValueError` when decoding a value failed
+    or an encoded value is too long.
+
+    >>> pref = BinaryPluginPref(__module_name__, backend='array')
+    >>> pref["counts"] = [0] * 100
+    """
+
+    backends = ('marshal', 'pickle', 'array')
+
+    def __init__(self, name=None, prefix_sep=".", prefix=None, sharded=True, backend='marshal',
+                 **kwargs):
+        if backend not in self.backends:
+            raise ValueError("Unknown backend: %s" % backend)
+        super().__init__(name, prefix_sep, prefix, sharded=sharded, **kwargs)
+        self.backend = backend
+
+    def serialize(self, obj):
+        if self.backend == 'pickle':
+            tag, data = "p", pickle.dumps(obj, protocol=5)
+        else:
+            packed = self.backend == 'array' and _pack_array(obj)
+            if packed:
+                tag, data = "a" + packed[0], packed[1]
+            else:
+                tag, data = "m", marshal.dumps(obj)
+        # The tag also keeps hexchat from converting the value to a number
+        obj = tag + ":" + base64.b64encode(data).decode('ascii')
+        if not self.sharded and len(obj) > MAX_VALUE_LENGTH:
+            # hexchat would truncate it
+            raise ValueError("Value too long (%d bytes) without sharded mode" % len(obj))
+        return super().serialize(obj)
+
+    def deserialize(self, obj):
+        obj = super().deserialize(obj)
+        if not isinstance(obj, str):
+            raise ValueError("Unexpected value: %r" % obj)
+        tag, _, data = obj.partition(":")
+        data = base64.b64decode(data)
+        if tag == "m":
+            return marshal.loads(data)
+        elif tag == "p":
+            return pickle.loads(data)
+        elif tag[:1] == "a" and tag[1:] in ARRAY_TYPECODES + ('d',):
+            return _unpack_array(tag[1:], data)
+        raise ValueError("Unknown serialization: %s" % tag)
@@ -8,7 +8,7 @@ import json
 import hexchat
 
 try:
-    from . import PluginPref, JSONPluginPref
+    from . import PluginPref, CachedPluginPref, JSONPluginPref, BinaryPluginPref
 except SystemError:
     # Add addons path to sys.path for win32
     # See https://github.com/hexchat/hexchat/issues/1396
@@ -24,18 +24,17 @@ except SystemError:
     from imp import reload
     reload(pluginpref)
 
-    from pluginpref import PluginPref, JSONPluginPref
+    from pluginpref import PluginPref, CachedPluginPref, JSONPluginPref, BinaryPluginPref
 
 __module_name__        = "PluginPref tests"
-__module_version__     = "0.2.0"
+__module_version__     = "0.3.0"
 __module_description__ = "tests for PluginPref abstraction"
 __module_author__      = "FichteFoll <fichtefoll2@googlemail.com>"
 
 
 def core_pluginpref_tests(prefs):
     # initial cleanup
-    for key in prefs:
-        prefs.delete(key)
+    prefs.clear()
     assert not prefs  # Should be empty!
 
     other_pref_keys = hexchat.list_pluginpref()
@@ -114,6 +113,25 @@ def test_jsonpluginpref():
                                         ('a_dict', a_dict),
                                         ('null', None)])
 
+    # memoized values must not be affected by modifying returned ones
+    prefs['a_list'].append(10)
+    assert prefs['a_list'] == a_list
+    prefs['nested'] = [a_list]
+    prefs['nested'][0].append(10)
+    assert prefs['nested'] == [a_list]
+    prefs['a_list'] = a_list  # unchanged, not written
+    assert hexchat.get_pluginpref(prefs.prefix + prefs.prefix_sep + "a_list") == json.dumps(a_list)
+    hexchat.set_pluginpref(prefs.prefix + prefs.prefix_sep + "a_list", "[1]")
+    assert prefs['a_list'] == [1]
+    prefs['a_list'] = a_list
+    assert prefs['a_list'] == a_list
+    # equal, but serialized differently
+    prefs['a_list'] = [float(i) for i in a_list]
+    assert type(prefs['a_list'][0]) is float
+    prefs['a_list'] = [bool(i) for i in a_list]
+    assert prefs['a_list'][1] is True
+    del prefs['nested']
+
     for key in prefs:
         prefs.delete(key)
     assert not prefs
@@ -122,9 +140,262 @@ def test_jsonpluginpref():
     print("test_jsonpluginpref passed")
 
 
+def test_cachedpluginpref():
+    prefs = CachedPluginPref("cached_prefs_test", flush_interval=None)
+    other_pref_keys = hexchat.list_pluginpref()
+    stored_name = prefs.prefix + prefs.prefix_sep + "mute"
+
+    for key in prefs:
+        prefs.delete(key)
+    prefs.flush()
+    assert not prefs
+    assert not prefs.dirty
+
+    prefs["mute"] = "#test"
+    prefs["count"] = 3
+    assert prefs["mute"] == "#test"
+    assert dict(prefs.items()) == {'mute': "#test", 'count': 3}
+    assert prefs.dirty
+    # not written yet
+    assert hexchat.get_pluginpref(stored_name) is None
+    assert other_pref_keys == hexchat.list_pluginpref()
+
+    # keys that failed to be written stay dirty
+    set_pluginpref = hexchat.set_pluginpref
+    hexchat.set_pluginpref = lambda name, value: (not name.endswith("count")
+                                                  and set_pluginpref(name, value))
+    try:
+        prefs.flush()
+        assert False, "should have raised"
+    except RuntimeError:
+        pass
+    finally:
+        hexchat.set_pluginpref = set_pluginpref
+    assert prefs.dirty
+
+    prefs.flush()
+    assert not prefs.dirty
+    assert hexchat.get_pluginpref(stored_name) == "#test"
+    assert hexchat.get_pluginpref(prefs.prefix + prefs.prefix_sep + "count") == 3
+
+    other = CachedPluginPref("cached_prefs_test", flush_interval=None)
+    assert dict(other.items()) == {'mute': "#test", 'count': 3}
+
+    # reload discards unflushed changes
+    prefs["mute"] = "#other"
+    prefs.reload()
+    assert prefs["mute"] == "#test"
+
+    try:
+        prefs["mute"] = [1, 2, 3]
+        assert False, "should have raised"
+    except RuntimeError:
+        pass
+
+    del prefs["mute"]
+    assert "mute" not in prefs
+    try:
+        del prefs["mute"]
+        assert False, "should have raised"
+    except KeyError:
+        pass
+    prefs.delete("count")
+    assert hexchat.get_pluginpref(stored_name) == "#test"
+    prefs.flush()
+    assert hexchat.get_pluginpref(stored_name) is None
+
+    assert not prefs
+    assert other_pref_keys == hexchat.list_pluginpref()
+    print("test_cachedpluginpref passed")
+
+
+class CallCounter(object):
+    """Count calls of a hexchat function while active."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+
+    def __enter__(self):
+        self.func = getattr(hexchat, self.name)
+
+        def counting(*args):
+            self.calls += 1
+            return self.func(*args)
+
+        setattr(hexchat, self.name, counting)
+        return self
+
+    def __exit__(self, *exc_info):
+        setattr(hexchat, self.name, self.func)
+
+
+def test_bulk_operations():
+    prefs = JSONPluginPref("bulk_prefs_test")
+    prefs.clear()
+    other_pref_keys = hexchat.list_pluginpref()
+    values = {"key%d" % i: [i] for i in range(20)}
+
+    with CallCounter('list_pluginpref') as listed, CallCounter('set_pluginpref') as written:
+        prefs.update_many(values, extra=True)
+    assert listed.calls == 1
+    assert written.calls == 21
+
+    with CallCounter('list_pluginpref') as listed:
+        assert dict(prefs.items()) == dict(values, extra=True)
+    assert listed.calls == 1
+
+    # only changed keys are written
+    with CallCounter('set_pluginpref') as written, CallCounter('del_pluginpref') as deleted:
+        prefs.update_many(values, extra=False)
+    assert written.calls == 1
+    assert deleted.calls == 0
+
+    # only the given keys are read, and unreadable values are overwritten
+    hexchat.set_pluginpref(prefs.prefix + prefs.prefix_sep + "broken", "{")
+    with CallCounter('get_pluginpref') as read, CallCounter('set_pluginpref') as written:
+        prefs.update_many(key0=[0], extra=True)
+    assert read.calls == 2
+    assert written.calls == 1
+    prefs.update_many(broken=[])
+    assert prefs['broken'] == []
+    del prefs['broken']
+
+    with CallCounter('list_pluginpref') as listed, CallCounter('set_pluginpref') as written:
+        with prefs.transaction() as data:
+            data['key0'].append(1)
+            del data['extra']
+    assert listed.calls == 1
+    assert written.calls == 1
+    assert prefs['key0'] == [0, 1]
+    assert 'extra' not in prefs
+
+    # equal, but serialized differently
+    with prefs.transaction() as data:
+        data['key1'] = [1.0]
+    assert type(prefs['key1'][0]) is float
+
+    # changes are discarded on errors
+    try:
+        with prefs.transaction() as data:
+            data['key0'] = "changed"
+            raise ZeroDivisionError
+    except ZeroDivisionError:
+        pass
+    assert prefs['key0'] == [0, 1]
+
+    # the naive way lists once per key
+    with CallCounter('list_pluginpref') as listed:
+        while prefs:
+            prefs.popitem()
+    assert listed.calls > len(values)
+
+    prefs.update_many(values)
+    with CallCounter('list_pluginpref') as listed:
+        prefs.clear()
+    assert listed.calls == 1
+    assert not prefs
+
+    assert other_pref_keys == hexchat.list_pluginpref()
+    print("test_bulk_operations passed")
+
+
+def test_sharded_jsonpluginpref():
+    prefs = JSONPluginPref("sharded_prefs_test", sharded=True)
+    other_pref_keys = hexchat.list_pluginpref()
+    stored_name = prefs.prefix + prefs.prefix_sep + "big"
+    big = {"nick%d" % i: list(range(i % 10)) for i in range(200)}
+
+    core_pluginpref_tests(prefs)
+
+    prefs['big'] = big
+    prefs['small'] = [1, 2, 3]
+    assert prefs.keys() == {'big', 'small'}
+    assert hexchat.get_pluginpref(stored_name + "#1").startswith("~")
+    assert all(len(str(hexchat.get_pluginpref(key))) <= 500
+               for key in hexchat.list_pluginpref())
+    assert JSONPluginPref("sharded_prefs_test", sharded=True)['big'] == big
+
+    # only changed shards are written
+    big['nick199'].append(10)
+    with CallCounter('set_pluginpref') as written:
+        prefs['big'] = big
+    assert written.calls == 2  # last shard and header
+    assert JSONPluginPref("sharded_prefs_test", sharded=True)['big'] == big
+
+    # obsolete shards are removed
+    prefs['big'] = [1]
+    assert stored_name + "#0" not in hexchat.list_pluginpref()
+    assert prefs['big'] == [1]
+
+    compressed = JSONPluginPref("sharded_prefs_test", compress=True)
+    compressed['big'] = big
+    assert hexchat.get_pluginpref(stored_name).startswith("~z")
+    assert JSONPluginPref("sharded_prefs_test", compress=True)['big'] == big
+
+    prefs.clear()
+    assert other_pref_keys == hexchat.list_pluginpref()
+    print("test_sharded_jsonpluginpref passed")
+
+
+def test_binarypluginpref():
+    values = {
+        'ints': [1, -200, 70000, 2 ** 40],
+        'floats': [0.5, 1e100],
+        'mixed': [1, "two", (3.0,), {'four': None}],
+        'bools': [True, False],
+        'empty': [],
+        'bytes': b"123",
+        'huge': [2 ** 70],
+    }
+
+    for backend in BinaryPluginPref.backends:
+        prefs = BinaryPluginPref("binary_prefs_test", backend=backend)
+        other_pref_keys = hexchat.list_pluginpref()
+        core_pluginpref_tests(prefs)
+
+        prefs.update_many(values)
+        for key, value in values.items():
+            assert prefs[key] == value
+            assert type(prefs[key]) is type(value)
+            assert isinstance(hexchat.get_pluginpref(prefs._keyname(key)), str)
+
+        # values stored with another backend are read, too
+        assert dict(BinaryPluginPref("binary_prefs_test").items()) == values
+
+        prefs.clear()
+        assert other_pref_keys == hexchat.list_pluginpref()
+
+    try:
+        BinaryPluginPref("binary_prefs_test", backend='yaml')
+        assert False, "should have raised"
+    except ValueError:
+        pass
+
+    # long values are sharded by default
+    prefs = BinaryPluginPref("binary_prefs_test", backend='array')
+    prefs['long'] = list(range(1000))
+    assert BinaryPluginPref("binary_prefs_test")['long'] == list(range(1000))
+    prefs.clear()
+
+    prefs = BinaryPluginPref("binary_prefs_test", sharded=False)
+    try:
+        prefs['long'] = list(range(1000))
+        assert False, "should have raised"
+    except ValueError:
+        pass
+    assert 'long' not in prefs
+
+    print("test_binarypluginpref passed")
+
+
 def main():
     test_pluginpref()
+    test_cachedpluginpref()
     test_jsonpluginpref()
+    test_bulk_operations()
+    test_sharded_jsonpluginpref()
+    test_binarypluginpref()
     print("all tests passed!")
 
 
@@ -8,6 +8,11 @@
   parts and joins again (or renames),
   the events are shown.
 - Events for nicks in your notify list are always shown.
+- Quits and rejoins caused by netsplits
+  are summarized in one line per channel.
+- Last-talk times are persisted in the config directory
+  and survive reloads and restarts.
+  They are also read from your channel logs, if logging is enabled.
 - Default threshold is 60 minutes.
 
 Works with ZNC bouncers
@@ -20,18 +25,47 @@ using [buffextras.py][].
 from __future__ import print_function, absolute_import
 
 import functools
+import heapq
 from itertools import zip_longest
+import mmap
+import os
+import queue
+import re
+import sys
+import threading
 import time
 
 import hexchat
 
+# Make imports work (see https://github.com/hexchat/hexchat/issues/1396)
+addons_path = os.path.join(hexchat.get_info("configdir"), "addons")
+if addons_path not in sys.path:
+    sys.path.append(addons_path)
+
+from util import rfc_lower, set_timeout  # noqa: E402
+from util.channels import ChannelIndex  # noqa: E402
+from util.hookstats import HookStats  # noqa: E402
+
+
 __module_name__ = "SmartFilter"
 __module_author__ = "FichteFoll"
-__module_version__ = "3.2.1"
+__module_version__ = "3.7.5"
 __module_description__ = "Intelligently hide parts, joins, user modes, and nick changes"
 
 LASTTALK_THRESHOLD = 1 * 60 * 60  # in seconds
 CLEAN_INTERVAL = 5 * 60  # in seconds
+NETSPLIT_DELAY = 2  # in seconds; time to collect netsplit events before summarizing
+PERSIST_INTERVAL = 30  # in seconds; how often new last-talk entries are written to disk
+LOAD_CHUNK_SIZE = 5000  # number of persisted entries loaded per main loop iteration
+JOINMAP_MAX_PER_CHANNEL = 2000  # hidden joins remembered per channel (None for no limit)
+JOINMAP_MAX_ENTRIES = 20000  # hidden joins remembered in total (None for no limit)
+
+LASTTALK_FILE = os.path.join(hexchat.get_info("configdir"), "smart_filter_lasttalk.tsv")
+BACKFILL_FROM_LOGS = True  # read last-talk times from log files when joining a channel
+
+# Quit reasons of netsplits consist of the two affected server names,
+# which some networks mask (e.g. "*.net *.split")
+netsplit_re = re.compile(r"^[\w*-]+(?:\.[\w*-]+)+ [\w*-]+(?:\.[\w*-]+)+$")
 
 
 def expand_server_channel(forward_context=False):
@@ -51,90 +85,606 @@ def expand_server_channel(forward_context=False):
         return decorator
 
 
+def _intern(string):
+    return sys.intern(string) if isinstance(string, str) else string
+
+
+class TimestampEntry(object):
+    """A single record of a TimestampMap.
+
+    Entries order by their timestamp
+    so they can be kept in a heap directly.
+    """
+
+    __slots__ = ('tmstmp', 'data', 'server', 'channel', 'nick')
+
+    def __init__(self, tmstmp, data, server, channel, nick):
+        self.tmstmp = tmstmp
+        self.data = data
+        self.server = _intern(server)
+        self.channel = _intern(channel)
+        self.nick = nick
+
+    def __lt__(self, other):
+        return self.tmstmp < other.tmstmp
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (self.__class__.__name__, self.tmstmp, self.data)
+
+
 class TimestampMap(object):
+    """Maps (server, channel, nick) to a timestamp and optional data.
+
+    Entries are stored in nested dicts per server and channel.
+    Expiry deadlines are additionally tracked in a min-heap
+    so that `clean` only needs to touch entries that actually expired.
+    Heap entries are invalidated lazily;
+    an entry is only acted upon if it is still stored in the map.
+    """
 
     def __init__(self, val=()):
         super(TimestampMap, self).__init__()
-        self._d = dict(val)
+        self._d = {}
+        self._len = 0
+        self._heap = []
+        for (server, channel, nick), (tmstmp, data) in dict(val).items():
+            self._insert(TimestampEntry(tmstmp, data, server, channel, nick))
+
+    def _nicks(self, server, channel, create=False):
+        channels = self._d.get(server)
+        if channels is None:
+            if not create:
+                return None
+            channels = self._d[_intern(server)] = {}
+        nicks = channels.get(channel)
+        if nicks is None and create:
+            nicks = channels[_intern(channel)] = {}
+        return nicks
+
+    def _rebuild_heap(self):
+        self._heap = [entry
+                      for channels in self._d.values()
+                      for nicks in channels.values()
+                      for entry in nicks.values()]
+        heapq.heapify(self._heap)
+
+    def _insert(self, entry):
+        nicks = self._nicks(entry.server, entry.channel, create=True)
+        if entry.nick not in nicks:
+            self._len += 1
+        nicks[entry.nick] = entry
+        heapq.heappush(self._heap, entry)
+        # Drop stale heap entries if they start to outweigh live ones,
+        # e.g. for users that talk a lot.
+        if len(self._heap) > 2 * self._len + 64:
+            self._rebuild_heap()
+
+    def _remove(self, server, channel, nick):
+        nicks = self._nicks(server, channel)
+        if not nicks:
+            return None
+        entry = nicks.pop(nick, None)
+        if entry is not None:
+            self._len -= 1
+            if not nicks:
+                channels = self._d[server]
+                del channels[channel]
+                if not channels:
+                    del self._d[server]
+        return entry
 
     @expand_server_channel
     def add(self, nick, tmstmp, data=None, server=None, channel=None):
-        self._d[(server, channel, nick)] = (tmstmp, data)
+        self._insert(TimestampEntry(tmstmp, data, server, channel, nick))
 
     def clean(self):
-        ref_time = time.time()
-        for key in list(self._d.keys()):
-            if (ref_time - self._d[key][0]) > LASTTALK_THRESHOLD:
-                del self._d[key]
+        deadline = time.time() - LASTTALK_THRESHOLD
+        heap = self._heap
+        while heap and heap[0].tmstmp < deadline:
+            entry = heapq.heappop(heap)
+            nicks = self._nicks(entry.server, entry.channel)
+            if nicks and nicks.get(entry.nick) is entry:
+                self._remove(entry.server, entry.channel, entry.nick)
         return True  # loopable
 
+    @expand_server_channel
+    def add_if_newer(self, nick, tmstmp, data=None, server=None, channel=None):
+        entry = self.get(nick, server=server, channel=channel)
+        if entry is None or entry.tmstmp < tmstmp:
+            self.add(nick, tmstmp, data, server=server, channel=channel)
+
     @expand_server_channel
     def rename(self, old_nick, new_nick, server=None, channel=None):
-        item = self.pop(old_nick, server=server, channel=channel)
-        if item:
+        entry = self.pop(old_nick, server=server, channel=channel)
+        if entry:
             # Could overwrite existing new_nick entry, but should not matter in practice
-            self._d[(server, channel, new_nick)] = item
+            entry.nick = new_nick
+            self._insert(entry)
 
     @expand_server_channel
     def pop(self, nick, default=None, server=None, channel=None):
-        item = self._d.pop((server, channel, nick), None)
-        return item if item and (time.time() - item[0]) < LASTTALK_THRESHOLD else default
+        entry = self._remove(server, channel, nick)
+        return entry if entry and (time.time() - entry.tmstmp) < LASTTALK_THRESHOLD else default
 
     @expand_server_channel
     def get(self, nick, default=None, server=None, channel=None):
-        item = self._d.get((server, channel, nick), None)
-        return item if item and (time.time() - item[0]) < LASTTALK_THRESHOLD else default
+        nicks = self._nicks(server, channel)
+        entry = nicks.get(nick) if nicks else None
+        return entry if entry and (time.time() - entry.tmstmp) < LASTTALK_THRESHOLD else default
+
+    @expand_server_channel
+    def get_many(self, nicks, server=None, channel=None):
+        """Return the unexpired entries of `nicks` in one channel, by nick."""
+        stored = self._nicks(server, channel)
+        if not stored:
+            return {}
+        threshold = time.time() - LASTTALK_THRESHOLD
+        entries = {}
+        for nick in nicks:
+            entry = stored.get(nick)
+            if entry and entry.tmstmp > threshold:
+                entries[nick] = entry
+        return entries
+
+    @expand_server_channel
+    def pop_many(self, nicks, server=None, channel=None):
+        """Remove `nicks` from one channel and return their unexpired entries, by nick."""
+        entries = self.get_many(nicks, server=server, channel=channel)
+        if self._nicks(server, channel):
+            for nick in nicks:
+                self._remove(server, channel, nick)
+        return entries
+
+    def __len__(self):
+        return self._len
 
     def __str__(self):
         return "%s(%s)" % (self.__class__.__name__, self._d)
 
 
+class PersistentTimestampMap(TimestampMap):
+    """TimestampMap that is backed by an append-only log file.
+
+    New entries are buffered and appended to the file on `flush`.
+    Popped entries (e.g. the old nick of a rename)
+    are logged as tombstones
+    that remove the entry again when loading.
+    The log is rewritten from the live entries in `clean`
+    once it contains too many obsolete lines.
+
+    Loading happens in chunks through `load_chunk`,
+    so it can be spread over several main loop iterations.
+    Entries already present in the map take precedence
+    over older persisted ones.
+    """
+
+    def __init__(self, path, val=()):
+        self.path = path
+        self._pending = []
+        self._logged = 0
+        self._loader = None
+        super(PersistentTimestampMap, self).__init__(val)
+
+    def _insert(self, entry):
+        super(PersistentTimestampMap, self)._insert(entry)
+        self._pending.append((entry.tmstmp, entry.server, entry.channel, entry.nick, ""))
+
+    @expand_server_channel
+    def pop(self, nick, default=None, server=None, channel=None):
+        entry = super(PersistentTimestampMap, self).pop(nick, server=server, channel=channel)
+        if entry is None:
+            return default
+        self._pending.append((entry.tmstmp, entry.server, entry.channel, nick, "\t-"))
+        return entry
+
+    def _iter_log(self):
+        try:
+            with open(self.path, encoding='utf-8', errors='replace') as f:
+                for line in f:
+                    yield line
+        except FileNotFoundError:
+            return
+
+    def load_chunk(self, userdata=None):
+        """Load up to `LOAD_CHUNK_SIZE` entries from the log file.
+
+        Returns whether there is more to load (for usage with `hook_timer`).
+        """
+        if self._loader is None:
+            self._loader = self._iter_log()
+        deadline = time.time() - LASTTALK_THRESHOLD
+        for i, line in enumerate(self._loader, 1):
+            self._logged += 1
+            fields = line.rstrip("\n").split("\t")
+            try:
+                tmstmp, server, channel, nick = fields[:4]
+                tmstmp = int(tmstmp)
+            except ValueError:
+                continue
+            if fields[4:] == ["-"]:
+                # Tombstone, only removes entries it could have superseded
+                existing = self.get(nick, server=server, channel=channel)
+                if existing is not None and existing.tmstmp <= tmstmp:
+                    self._remove(server, channel, nick)
+            elif len(fields) == 4 and tmstmp >= deadline:
+                existing = self.get(nick, server=server, channel=channel)
+                if existing is None or existing.tmstmp < tmstmp:
+                    entry = TimestampEntry(tmstmp, None, server, channel, nick)
+                    super(PersistentTimestampMap, self)._insert(entry)
+            if i >= LOAD_CHUNK_SIZE:
+                return True
+
+        self._loader = False
+        return False
+
+    @property
+    def loading(self):
+        return bool(self._loader)
+
+    def flush(self, userdata=None):
+        if self._pending:
+            lines = ["%d\t%s\t%s\t%s%s\n" % record for record in self._pending]
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+            except OSError as e:
+                print("Could not write {}: {}".format(self.path, e))
+            else:
+                self._logged += len(lines)
+                self._pending = []
+        return True  # loopable
+
+    def compact(self):
+        """Rewrite the log file to contain only the live entries."""
+        self._pending = []
+        self._rebuild_heap()  # conveniently collects all live entries
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.writelines("%d\t%s\t%s\t%s\n" % (entry.tmstmp, entry.server,
+                                                       entry.channel, entry.nick)
+                             for entry in self._heap)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print("Could not write {}: {}".format(self.path, e))
+        else:
+            self._logged = len(self._heap)
+
+    def clean(self):
+        super(PersistentTimestampMap, self).clean()
+        if not self.loading and self._logged > 2 * len(self) + 1024:
+            self.compact()
+        return True  # loopable
+
+
 class JoinMap(TimestampMap):
+    """TimestampMap of hidden joins.
 
-    def __init__(self, val=()):
+    Stores the join event's arguments following the nick as data.
+
+    The number of entries can be limited per channel and in total.
+    When a limit is exceeded,
+    the least recently added entries are evicted first.
+    """
+
+    def __init__(self, val=(), max_per_channel=None, max_entries=None):
+        self.max_per_channel = max_per_channel
+        self.max_entries = max_entries
+        self.channel_evictions = 0
+        self.total_evictions = 0
         super(JoinMap, self).__init__(val)
         self.is_emitting = False
 
-    @expand_server_channel
-    def rename(self, old_nick, new_nick, server=None, channel=None):
-        item = self.get(old_nick, server=server, channel=channel)
-        if item:
-            item[1][0] = new_nick
-        super(JoinMap, self).rename(old_nick, new_nick, server=server, channel=channel)
+    def _insert(self, entry):
+        # Re-insert existing nicks so that dicts stay ordered by recency
+        self._remove(entry.server, entry.channel, entry.nick)
+        super(JoinMap, self)._insert(entry)
+
+        if self.max_per_channel is not None:
+            nicks = self._nicks(entry.server, entry.channel)
+            while len(nicks) > self.max_per_channel:
+                self._remove(entry.server, entry.channel, next(iter(nicks)))
+                self.channel_evictions += 1
+
+        if self.max_entries is not None:
+            while self._len > self.max_entries:
+                self._evict_oldest()
+                self.total_evictions += 1
+
+    def counters(self):
+        return {
+            'size': len(self),
+            'channel_evictions': self.channel_evictions,
+            'total_evictions': self.total_evictions,
+        }
+
+    def _evict_oldest(self):
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            nicks = self._nicks(entry.server, entry.channel)
+            if nicks and nicks.get(entry.nick) is entry:
+                self._remove(entry.server, entry.channel, entry.nick)
+                return
 
     @expand_server_channel(True)
     def pop_and_emit(self, nick, server=None, channel=None, context=hexchat):
-        item = self.pop(nick, server=server, channel=channel)
-        if item:
-            tmstmp, data = item
+        entry = self.pop(nick, server=server, channel=channel)
+        if entry:
             self.is_emitting = True
-            context.emit_print('Join', *data, time=tmstmp)
+            context.emit_print('Join', entry.nick, *entry.data, time=entry.tmstmp)
             self.is_emitting = False
 
 
-tmap = TimestampMap()
-jmap = JoinMap()
+class NetsplitBatch(object):
+    """Collects netsplit-related events and prints one summary line per channel.
 
+    The summary is printed `NETSPLIT_DELAY` seconds
+    after the first event for a channel has been added.
+    The collected nicks are then looked up all at once
+    by `classify(server, channel, events)`,
+    which receives a dict of nick to event data
+    and returns the nicks to show.
+    """
 
-def get_user(nick, list_, context=hexchat):
-    for user in context.get_list(list_):
-        if hexchat.nickcmp(user.nick, nick) == 0:
-            return user
+    def __init__(self, fmt, classify):
+        super(NetsplitBatch, self).__init__()
+        self.fmt = fmt
+        self.classify = classify
+        self._pending = {}
+
+    @expand_server_channel
+    def add(self, nick, reason, data=None, server=None, channel=None):
+        key = (server, channel)
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = {
+                'context': hexchat.get_context(),
+                'reason': reason,
+                'events': {},
+            }
+            set_timeout(self.flush, NETSPLIT_DELAY * 1000, args=(key,))
+        batch['events'][nick] = data
+
+    def flush(self, key):
+        batch = self._pending.pop(key, None)
+        if not batch:
+            return
+        server, channel = key
+        events = batch['events']
+        shown = self.classify(server, channel, events)
+        hidden = len(events) - len(shown)
+        line = self.fmt.format(reason=batch['reason'], count=len(events))
+        if shown:
+            line += ": " + ", ".join(shown)
+        if hidden:
+            line += " (%d hidden)" % hidden
+        batch['context'].prnt(line)
+
+
+def classify_split_quits(server, channel, events):
+    jmap.pop_many(events, server=server, channel=channel)
+    talked = tmap.get_many(events, server=server, channel=channel)
+    return [nick for nick in events if nick in talked or check_notify(nick)]
+
+
+def classify_split_joins(server, channel, events):
+    talked = tmap.get_many(events, server=server, channel=channel)
+    shown = []
+    for nick, (tmstmp, args) in events.items():
+        if nick in talked or check_notify(nick):
+            shown.append(nick)
+        else:
+            jmap.add(nick, tmstmp, args, server=server, channel=channel)
+    return shown
+
+
+tmap = PersistentTimestampMap(LASTTALK_FILE)
+jmap = JoinMap(max_per_channel=JOINMAP_MAX_PER_CHANNEL, max_entries=JOINMAP_MAX_ENTRIES)
+# nicks that quit due to a netsplit, with the quit reason as data
+smap = TimestampMap()
+quit_batch = NetsplitBatch("*\tNetsplit {reason}: {count} user(s) quit", classify_split_quits)
+join_batch = NetsplitBatch("*\tNetsplit {reason} over: {count} user(s) rejoined",
+                           classify_split_joins)
+
+
+###############################################################################
+# Log file backfilling
+
+log_msg_re = re.compile(r"^<[~&@%+]?([^>\s]+)>\t")
+log_action_re = re.compile(r"^\*\t[~&@%+]?(\S+) ")
+
+
+# text.c:log_create_filename
+def log_create_filename(channame):
+    if not channame:
+        return channame
+    elif sys.platform == 'win32':
+        return re.sub(r'[\\|/><:"*?]', "_", channame)
+    else:
+        return rfc_lower(channame.replace("/", "_"))
+
+
+# text.c:log_create_pathname, see also viewlog.lua
+def log_create_pathname(context=hexchat):
+    network = log_create_filename(context.get_info('network')) or "NETWORK"
+    server = log_create_filename(context.get_info('server'))
+    channel = log_create_filename(context.get_info('channel'))
+    if not server:
+        return None
+    if hexchat.nickcmp(channel, server) == 0:
+        channel = 'server'
+
+    # substitute variables after strftime expansion
+    fname = re.sub(r"%([scn])", "\001\\1", hexchat.get_prefs('irc_logmask'))
+    fname = time.strftime(fname)
+    fname = (fname.replace("\001n", network)
+                  .replace("\001s", server)
+                  .replace("\001c", channel))
+    return os.path.join(hexchat.get_info('configdir'), "logs", fname)
+
+
+def iter_lines_reversed(path):
+    """Yield the lines of a file as bytes, starting with the last one."""
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            end = len(m)
+            if m[end - 1:end] == b"\n":
+                end -= 1
+            while end >= 0:
+                start = m.rfind(b"\n", 0, end) + 1
+                yield m[start:end]
+                end = start - 1
+
+
+def parse_log_lasttalk(path, stamp_format, threshold):
+    """Collect the last time each nick talked according to a log file.
+
+    Only reads the log from the end until lines are older than `threshold`.
+    Lines with timestamps that can't be parsed are ignored.
+    """
+    stamp_len = len(time.strftime(stamp_format))
+    now = time.time()
+    localtime = time.localtime(now)
+    lasttalk = {}
+
+    for line in iter_lines_reversed(path):
+        line = line.decode('utf-8', 'replace')
+        try:
+            tm = time.strptime(line[:stamp_len], stamp_format)
+        except ValueError:
+            continue
+        if tm.tm_year == 1900:  # not part of the format
+            tm = tm[:0] + (localtime.tm_year,) + tm[1:8] + (-1,)
+            tmstmp = time.mktime(tm)
+            if tmstmp > now + 24 * 60 * 60:
+                tmstmp = time.mktime((localtime.tm_year - 1,) + tm[1:])
+        else:
+            tmstmp = time.mktime(tm[:8] + (-1,))
+        if tmstmp < threshold:
+            break
+
+        text = line[stamp_len:]
+        match = log_msg_re.match(text) or log_action_re.match(text)
+        if match:
+            lasttalk.setdefault(match.group(1), int(tmstmp))
+
+    return lasttalk
+
+
+def backfill_lasttalk(contexts):
+    """Read last-talk times for the given channel contexts from their log files.
+
+    Files are read and parsed in a separate thread.
+    Results are added to `tmap` from the main thread.
+    """
+    jobs = []
+    for context in contexts:
+        path = log_create_pathname(context)
+        if path and os.path.isfile(path):
+            jobs.append((context.get_info('server'), context.get_info('channel'), path))
+    if not jobs:
+        return
+
+    stamp_format = hexchat.get_prefs('stamp_log_format')
+    threshold = time.time() - LASTTALK_THRESHOLD
+    results = queue.Queue()
+
+    def worker():
+        for server, channel, path in jobs:
+            try:
+                lasttalk = parse_log_lasttalk(path, stamp_format, threshold)
+            except (OSError, ValueError):
+                continue
+            results.put((server, channel, lasttalk))
+
+    def poll_results(userdata):
+        while True:
+            try:
+                server, channel, lasttalk = results.get_nowait()
+            except queue.Empty:
+                break
+            for nick, tmstmp in lasttalk.items():
+                tmap.add_if_newer(nick, tmstmp, server=server, channel=channel)
+        return thread.is_alive() or not results.empty()
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    hexchat.hook_timer(500, poll_results)
+
+
+###############################################################################
+
+
+class NotifyCache(object):
+    """Casefolded set of the nicks in the notify list.
+
+    Built lazily on first lookup
+    and invalidated whenever the notify list may have changed.
+    """
+
+    def __init__(self):
+        super(NotifyCache, self).__init__()
+        self._nicks = None
+
+    def invalidate(self, *args):
+        self._nicks = None
+        return hexchat.EAT_NONE
+
+    def __contains__(self, nick):
+        if self._nicks is None:
+            self._nicks = {rfc_lower(item.nick) for item in hexchat.get_list('notify')}
+        return rfc_lower(nick) in self._nicks
+
+
+notify_cache = NotifyCache()
+channel_index = ChannelIndex()
 
 
 def check_notify(nick):
-    return get_user(nick, 'notify') is not None
+    return nick in notify_cache
+
+
+def get_channel_modes(context=hexchat):
+    return channel_index.modes(context)
 
 
-def get_channel_list(context=None):
-    if context is None:
-        context = hexchat.get_context()
+MODE_NICK, MODE_PARAM, MODE_PARAM_SET, MODE_NO_PARAM = range(4)
 
-    for item in context.get_list('channels'):
-        if item.context == context:
-            return item
+# server -> {mode char: MODE_*}
+mode_tables = {}
 
-    return None
+
+def build_mode_table(modes):
+    """Map mode chars to the kind of argument they expect.
+
+    Built from the PREFIX and CHANMODES ISUPPORT tokens
+    in a ChannelModes tuple.
+    """
+    # assure we have 4 entries
+    chanmodes = [x for x, _ in zip_longest(modes.chanmodes.split(','), range(4), fillvalue="")]
+    table = dict.fromkeys(chanmodes[3], MODE_NO_PARAM)
+    table.update(dict.fromkeys(chanmodes[2], MODE_PARAM_SET))
+    table.update(dict.fromkeys(chanmodes[0] + chanmodes[1], MODE_PARAM))
+    table.update(dict.fromkeys(modes.nickmodes, MODE_NICK))
+    return table
+
+
+def get_mode_table():
+    server = hexchat.get_info('server')
+    table = mode_tables.get(server)
+    if table is None:
+        modes = get_channel_modes()
+        if not modes:
+            return None
+        table = mode_tables[server] = build_mode_table(modes)
+    return table
+
+
+def isupport_cb(word, word_eol, userdata):
+    mode_tables.pop(hexchat.get_info('server'), None)
+    return hexchat.EAT_NONE
 
 
 def split_irc_message(message):
@@ -195,39 +745,35 @@ def raw_mode_cb(word, word_eol, userdata):
     if target != hexchat.get_info('channel'):
         return hexchat.EAT_NONE
 
-    list_ = get_channel_list()
-    if not list_:
+    table = get_mode_table()
+    if table is None:
         return hexchat.EAT_NONE
 
     # Parse the raw mode message and eat it
     # if it only affects nicks we don't care about
     # (and not the channel).
-    nickmodes = list_.nickmodes
-    # assure we have 4 entries
-    chanmodes = [x for x, _ in zip_longest(list_.chanmodes.split(','), range(4), fillvalue="")]
-
     eat = True
     mode_iter = iter(mode_args)
     for param in mode_iter:
         action, *mode_chars = param
         assert action in "+-"
         for char in mode_chars:
-            if char in nickmodes:  # qaohv; expects nick
+            kind = table.get(char)
+            if kind == MODE_NICK:  # qaohv; expects nick
                 nick = next(mode_iter)
                 eat &= not check_you(nick)
                 eat &= not check_notify(nick)
                 eat &= check_lasttalk(nick) is not hexchat.EAT_NONE
                 continue
-            elif char in chanmodes[0]:  # beI; expects hostmask
-                next(mode_iter)
-            elif char in chanmodes[1]:  # k; expects "key"
+            elif kind == MODE_PARAM:  # beIk; expects hostmask or "key"
                 next(mode_iter)
-            elif char in chanmodes[2]:  # l; expects number but only if +
+            elif kind == MODE_PARAM_SET:  # l; expects number but only if +
                 if action == '+':
                     next(mode_iter)
-            elif char not in chanmodes[3]:
+            elif kind is None:
                 print("Unexpected mode_char '{}' in '{}'".format(char, param))
-            eat = False  # mode change affects channel
+            # mode change affects channel
+            return hexchat.EAT_NONE
 
     if eat:
         # Eat for all, so this plays better with better_raw_modes.py.
@@ -248,13 +794,28 @@ def join_cb(word, word_eol, userdata, attrs):
     if jmap.is_emitting:
         return hexchat.EAT_NONE
     nick = hexchat.strip(word[0])
+    server = hexchat.get_info('server')
+    channel = hexchat.get_info('channel')
+    tmstmp = attrs.time or int(time.time())
+
+    # Rejoins after a netsplit are looked up in bulk when summarized
+    split = smap.pop(nick, server=server, channel=channel)
+    if split is not None:
+        join_batch.add(nick, split.data, (tmstmp, tuple(word[1:])),
+                       server=server, channel=channel)
+        return hexchat.EAT_HEXCHAT
+
     if check_notify(nick):
         return hexchat.EAT_NONE
-    else:
-        eat = check_lasttalk(nick)
-        if eat:
-            jmap.add(nick, attrs.time or int(time.time()), word)
-        return eat
+    eat = check_lasttalk(nick)
+    if eat:
+        jmap.add(nick, tmstmp, tuple(word[1:]), server=server, channel=channel)
+    return eat
+
+
+def you_join_cb(word, word_eol, userdata):
+    backfill_lasttalk([hexchat.get_context()])
+    return hexchat.EAT_NONE
 
 
 def part_cb(word, word_eol, userdata):
@@ -267,22 +828,58 @@ def part_cb(word, word_eol, userdata):
     return check_lasttalk(word[0])
 
 
+def quit_cb(word, word_eol, userdata):
+    reason = word[1] if len(word) > 1 else ""
+    if not netsplit_re.match(reason):
+        return part_cb(word, word_eol, userdata)
+
+    # Summarize netsplits instead of showing individual quits;
+    # nicks are looked up in bulk when summarized
+    nick = hexchat.strip(word[0])
+    server = hexchat.get_info('server')
+    channel = hexchat.get_info('channel')
+    smap.add(nick, int(time.time()), reason, server=server, channel=channel)
+    quit_batch.add(nick, reason, server=server, channel=channel)
+    return hexchat.EAT_HEXCHAT
+
+
 if __name__ == '__main__':
-    for event in ('Quit', 'Part', 'Part with Reason'):
-        hexchat.hook_print(event, part_cb)
+    hook_stats = HookStats(__module_name__)
+
+    for event in ('Part', 'Part with Reason'):
+        hook_stats.hook_print(event, part_cb)
+    hook_stats.hook_print('Quit', quit_cb)
 
     for event in ('Channel Operator', 'Channel Voice', 'Channel Half-Operator'):
-        hexchat.hook_print(event, mode_cb)
+        hook_stats.hook_print(event, mode_cb)
 
     for event in ('Channel Action', 'Channel Action Hilight',
                   'Channel Message', 'Channel Msg Hilight'):
-        hexchat.hook_print_attrs(event, msg_cb, event)
+        hook_stats.hook_print_attrs(event, msg_cb, event)
+
+    hook_stats.hook_print('Raw Modes', raw_mode_cb, priority=hexchat.PRI_LOW)
+    hook_stats.hook_server('005', isupport_cb)
+    hook_stats.hook_print_attrs('Join', join_cb)
+    hook_stats.hook_print('Change Nick', nick_cb)
 
-    hexchat.hook_print('Raw Modes', raw_mode_cb, priority=hexchat.PRI_LOW)
-    hexchat.hook_print_attrs('Join', join_cb)
-    hexchat.hook_print('Change Nick', nick_cb)
+    for event in ('Notify Online', 'Notify Offline'):
+        hook_stats.hook_print(event, notify_cache.invalidate)
+    hook_stats.hook_command('NOTIFY', notify_cache.invalidate)
+    hook_stats.add_counters("joinmap", jmap.counters)
+    # The notify list can also be edited through the GUI, which we can't hook
+    hexchat.hook_timer(CLEAN_INTERVAL * 1000, lambda x: notify_cache.invalidate() or True)
 
     hexchat.hook_timer(CLEAN_INTERVAL * 1000, lambda x: jmap.clean())
     hexchat.hook_timer(CLEAN_INTERVAL * 1000, lambda x: tmap.clean())
+    hexchat.hook_timer(CLEAN_INTERVAL * 1000, lambda x: smap.clean())
+
+    hexchat.hook_timer(0, tmap.load_chunk)
+    hexchat.hook_timer(PERSIST_INTERVAL * 1000, tmap.flush)
+    hexchat.hook_unload(tmap.flush)
+
+    if BACKFILL_FROM_LOGS:
+        hook_stats.hook_print('You Join', you_join_cb)
+        backfill_lasttalk(item.context for item in hexchat.get_list('channels')
+                          if item.type == 2)
 
     print(__module_name__, __module_version__, "loaded")
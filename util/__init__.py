@@ -1,5 +1,10 @@
 """Selected utility functions for hexchat plugin development.
 
+Submodules:
+
+- channels: incrementally maintained index of channels and their users
+- hookstats: call counters and latency statistics for hook callbacks
+
 Exported decorators:
 
 - only_on
@@ -7,6 +12,7 @@ Exported decorators:
 
 Exported functions:
 
+- rfc_lower
 - set_timeout
 - event_text_to_format_string
 - print_text
@@ -20,13 +26,14 @@ import threading
 import hexchat
 
 
-__version__ = "0.2.0"
+__version__ = "0.3.0"
 versioninfo = tuple(map(int, __version__.split(".")))
 __author__ = "FichteFoll <fichtefoll2@googlemail.com>"
 
 __all__ = (
     'only_on',
     'no_recursion',
+    'rfc_lower',
     'set_timeout',
     'event_text_to_format_string',
     'print_event',
@@ -101,6 +108,24 @@ def no_recursion(func):
     return wrapper
 
 
+# util.c:rfc_tolowertab, as used by `hexchat.nickcmp`
+# https://github.com/hexchat/hexchat/blob/c79ce843f495b913ddafa383e6cf818ac99b4f15/src/common/util.c#L1079-L1081
+_rfc_lower_table = str.maketrans(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZ[]\\^",
+    "abcdefghijklmnopqrstuvwxyz{}|~",
+)
+
+
+def rfc_lower(nick):
+    """Casefold a nick or channel name like hexchat does (RFC 1459).
+
+    Two names compare equal with `hexchat.nickcmp`
+    if and only if their `rfc_lower` results are equal,
+    so the result can be used as a dict key or set member.
+    """
+    return nick.translate(_rfc_lower_table)
+
+
 def set_timeout(callback, delay=0, args=(), kwargs={}):
     """Delay executiong of a function for `delay` ms.
 
@@ -0,0 +1,174 @@
+"""Incrementally maintained index of channels and their users.
+
+Exported classes:
+
+- ChannelIndex
+- ChannelModes
+- IndexedUser
+"""
+
+from collections import namedtuple
+
+import hexchat
+
+from . import rfc_lower
+
+
+__all__ = (
+    'ChannelIndex',
+    'ChannelModes',
+    'IndexedUser',
+)
+
+
+IndexedUser = namedtuple('IndexedUser', 'nick host')
+# The fields of a channel list item that the server announces with ISUPPORT
+ChannelModes = namedtuple('ChannelModes', 'nickprefixes nickmodes chanmodes')
+
+
+class ChannelIndex(object):
+    """Index of channel modes and channel users.
+
+    Replaces walks over `hexchat.get_list('channels')`
+    and `hexchat.get_list('users')` with dict lookups.
+
+    Modes are cached per server
+    until the server sends an 005 (ISUPPORT).
+    Other fields of channel list items change too often to be cached.
+    A channel's users are loaded on first access
+    and afterwards kept up to date from JOIN, PART, KICK, QUIT and NICK messages.
+    They are reloaded after a NAMES reply.
+
+    Hooks belong to the plugin that creates an instance,
+    so every plugin should create its own.
+
+    Example usage:
+
+    >>> index = ChannelIndex()
+    >>> index.modes().nickmodes
+    'qaohv'
+    >>> index.get_user("FichteFoll")
+    IndexedUser(nick='FichteFoll', host='~fichte@example.com')
+    >>> index.user_count()
+    42
+    """
+
+    def __init__(self):
+        super(ChannelIndex, self).__init__()
+        self._modes = {}  # server -> ChannelModes
+        self._users = {}  # (server, channel) -> {casefolded nick: IndexedUser}
+
+        for command, callback in (('JOIN', self._join_cb),
+                                  ('PART', self._part_cb),
+                                  ('KICK', self._kick_cb),
+                                  ('QUIT', self._quit_cb),
+                                  ('NICK', self._nick_cb),
+                                  ('366', self._endofnames_cb),
+                                  ('005', self._isupport_cb)):
+            # Other plugins may eat these, so run first.
+            hexchat.hook_server(command, callback, priority=hexchat.PRI_HIGHEST)
+
+    @staticmethod
+    def _key(channel, server=None):
+        if server is None:
+            server = hexchat.get_info('server')
+        return (server, rfc_lower(channel))
+
+    @staticmethod
+    def _context_key(context):
+        return (context.get_info('server'), rfc_lower(context.get_info('channel') or ""))
+
+    @staticmethod
+    def _is_you(nick):
+        return hexchat.nickcmp(nick, hexchat.get_info('nick')) == 0
+
+    def _server_users(self, server):
+        for (user_server, _), users in self._users.items():
+            if user_server == server:
+                yield users
+
+    def modes(self, context=hexchat):
+        """Return the ChannelModes of a context's server, or `None`."""
+        server = context.get_info('server')
+        modes = self._modes.get(server)
+        if modes is None:
+            for item in hexchat.get_list('channels'):
+                if item.server == server:
+                    modes = self._modes[server] = ChannelModes(item.nickprefixes,
+                                                               item.nickmodes, item.chanmodes)
+                    break
+        return modes
+
+    def users(self, context=hexchat):
+        """Return a dict of casefolded nicks to IndexedUsers of a context.
+
+        Must not be modified.
+        """
+        key = self._context_key(context)
+        users = self._users.get(key)
+        if users is None:
+            users = self._users[key] = {rfc_lower(user.nick): IndexedUser(user.nick, user.host)
+                                        for user in context.get_list('users')}
+        return users
+
+    def get_user(self, nick, context=hexchat):
+        """Return the IndexedUser for a nick in a context, or `None`."""
+        return self.users(context).get(rfc_lower(nick))
+
+    def user_count(self, context=hexchat):
+        return len(self.users(context))
+
+    def _join_cb(self, word, word_eol, userdata):
+        nick, _, host = word[0][1:].partition("!")
+        key = self._key(word[2].lstrip(":"))
+        if self._is_you(nick):
+            self._users.pop(key, None)
+        else:
+            users = self._users.get(key)
+            if users is not None:
+                users[rfc_lower(nick)] = IndexedUser(nick, host)
+        return hexchat.EAT_NONE
+
+    def _remove(self, channel, nick):
+        key = self._key(channel)
+        if self._is_you(nick):
+            self._users.pop(key, None)
+        else:
+            users = self._users.get(key)
+            if users is not None:
+                users.pop(rfc_lower(nick), None)
+
+    def _part_cb(self, word, word_eol, userdata):
+        nick = word[0][1:].partition("!")[0]
+        for channel in word[2].lstrip(":").split(","):
+            self._remove(channel, nick)
+        return hexchat.EAT_NONE
+
+    def _kick_cb(self, word, word_eol, userdata):
+        self._remove(word[2], word[3])
+        return hexchat.EAT_NONE
+
+    def _quit_cb(self, word, word_eol, userdata):
+        folded_nick = rfc_lower(word[0][1:].partition("!")[0])
+        for users in self._server_users(hexchat.get_info('server')):
+            users.pop(folded_nick, None)
+        return hexchat.EAT_NONE
+
+    def _nick_cb(self, word, word_eol, userdata):
+        old_nick = word[0][1:].partition("!")[0]
+        new_nick = word[2].lstrip(":")
+        folded_old, folded_new = rfc_lower(old_nick), rfc_lower(new_nick)
+        for users in self._server_users(hexchat.get_info('server')):
+            user = users.pop(folded_old, None)
+            if user is not None:
+                users[folded_new] = user._replace(nick=new_nick)
+        return hexchat.EAT_NONE
+
+    def _endofnames_cb(self, word, word_eol, userdata):
+        # :server 366 <nick> <channel> :End of /NAMES list.
+        self._users.pop(self._key(word[3]), None)
+        return hexchat.EAT_NONE
+
+    def _isupport_cb(self, word, word_eol, userdata):
+        self._modes.pop(hexchat.get_info('server'), None)
+        return hexchat.EAT_NONE
@@ -0,0 +1,159 @@
+"""Call counters and latency statistics for hook callbacks.
+
+Exported classes:
+
+- HookStats
+"""
+
+from collections import Counter, deque
+import functools
+import time
+
+import hexchat
+
+
+__all__ = (
+    'HookStats',
+)
+
+
+SAMPLE_SIZE = 1000  # number of most recent latencies to compute percentiles from
+
+EAT_NAMES = {
+    hexchat.EAT_NONE: 'none',
+    hexchat.EAT_HEXCHAT: 'hexchat',
+    hexchat.EAT_PLUGIN: 'plugin',
+    hexchat.EAT_ALL: 'all',
+}
+
+HELP_STR = """\
+Usage: /ADDONSTATS [ON | OFF | RESET] - Show or control hook callback statistics
+Statistics are collected only while enabled."""
+
+
+class CallbackStats(object):
+    __slots__ = ('calls', 'total', 'samples', 'outcomes')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+        self.outcomes = Counter()
+
+    def record(self, duration, result):
+        self.calls += 1
+        self.total += duration
+        self.samples.append(duration)
+        self.outcomes[hexchat.EAT_NONE if result is None else result] += 1
+
+    def percentile(self, pct):
+        if not self.samples:
+            return 0.0
+        samples = sorted(self.samples)
+        return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+    def __str__(self):
+        outcomes = " ".join("{}={}".format(EAT_NAMES.get(eat, eat), count)
+                            for eat, count in sorted(self.outcomes.items()))
+        return ("{s.calls} calls, {total:.1f} ms total, {avg:.3f} ms avg, {p99:.3f} ms p99, "
+                "eat: {outcomes}"
+                .format(s=self, total=self.total * 1000, avg=self.total * 1000 / (self.calls or 1),
+                        p99=self.percentile(99) * 1000, outcomes=outcomes or "-"))
+
+
+class HookStats(object):
+    """Registry that wraps hook callbacks to collect statistics.
+
+    Provides the `hook_*` functions of the hexchat module
+    with identical signatures.
+    Callbacks registered through them record
+    their number of calls, cumulative and 99th percentile latency
+    as well as the distribution of returned `EAT_*` values.
+
+    Recording is disabled by default
+    and only costs an attribute lookup per call while disabled.
+    Registers the `/ADDONSTATS` command
+    to enable, disable, reset and show the statistics.
+
+    Example usage:
+
+    >>> stats = HookStats(__module_name__)
+    >>> stats.hook_print('Join', join_cb)
+    >>> stats.enabled = True
+    """
+
+    def __init__(self, name, enabled=False):
+        super(HookStats, self).__init__()
+        self.name = name
+        self.enabled = enabled
+        self.stats = {}
+        self.counters = {}
+        hexchat.hook_command("ADDONSTATS", self._command_cb, help=HELP_STR)
+
+    def wrap(self, label, callback):
+        """Wrap `callback` to record statistics under `label`."""
+        self.stats.setdefault(label, CallbackStats())
+
+        @functools.wraps(callback)
+        def wrapper(*args):
+            if not self.enabled:
+                return callback(*args)
+            start = time.perf_counter()
+            result = callback(*args)
+            self.stats[label].record(time.perf_counter() - start, result)
+            return result
+
+        return wrapper
+
+    def _label(self, kind, name, callback):
+        return "{} {!r} {}".format(kind, name, getattr(callback, '__name__', callback))
+
+    def hook_print(self, name, callback, userdata=None, priority=hexchat.PRI_NORM):
+        callback = self.wrap(self._label('print', name, callback), callback)
+        return hexchat.hook_print(name, callback, userdata, priority)
+
+    def hook_print_attrs(self, name, callback, userdata=None, priority=hexchat.PRI_NORM):
+        callback = self.wrap(self._label('print', name, callback), callback)
+        return hexchat.hook_print_attrs(name, callback, userdata, priority)
+
+    def hook_server(self, name, callback, userdata=None, priority=hexchat.PRI_NORM):
+        callback = self.wrap(self._label('server', name, callback), callback)
+        return hexchat.hook_server(name, callback, userdata, priority)
+
+    def hook_server_attrs(self, name, callback, userdata=None, priority=hexchat.PRI_NORM):
+        callback = self.wrap(self._label('server', name, callback), callback)
+        return hexchat.hook_server_attrs(name, callback, userdata, priority)
+
+    def hook_command(self, name, callback, userdata=None, priority=hexchat.PRI_NORM, help=None):
+        callback = self.wrap(self._label('command', name, callback), callback)
+        return hexchat.hook_command(name, callback, userdata, priority, help)
+
+    def add_counters(self, label, func):
+        """Show the dict returned by `func` under `label` with the statistics."""
+        self.counters[label] = func
+
+    def reset(self):
+        for label in self.stats:
+            self.stats[label] = CallbackStats()
+
+    def _command_cb(self, word, word_eol, userdata):
+        action = word[1].lower() if len(word) > 1 else None
+        if action == 'on':
+            self.enabled = True
+        elif action == 'off':
+            self.enabled = False
+        elif action == 'reset':
+            self.reset()
+        elif action is not None:
+            print(HELP_STR)
+            return hexchat.EAT_ALL
+        else:
+            print("{} ({}):".format(self.name, "enabled" if self.enabled else "disabled"))
+            for label, stats in sorted(self.stats.items()):
+                print("  {}: {}".format(label, stats))
+            for label, func in sorted(self.counters.items()):
+                print("  {}: {}".format(label, " ".join("{}={}".format(*item)
+                                                        for item in func().items())))
+
+        # Let the other plugins' hooks see the command as well
+        return hexchat.EAT_HEXCHAT
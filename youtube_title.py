@@ -2,13 +2,20 @@
 """
 
 import builtins
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import json
 import re
 import os
 import sys
+import threading
+import time
 
 import hexchat
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Make imports work (see https://github.com/hexchat/hexchat/issues/1396)
 addons_path = os.path.join(hexchat.get_info("configdir"), "addons")
@@ -17,13 +24,14 @@ if addons_path not in sys.path:
 
 from pluginpref import PluginPref, JSONPluginPref  # noqa: E402
 from util import set_timeout  # noqa: E402
+from util.hookstats import HookStats  # noqa: E402
 
 
 ###############################################################################
 
 
 __module_name__        = "YouTube Title"
-__module_version__     = "0.3.3"
+__module_version__     = "0.5.8"
 __module_description__ = "Scans text for YouTube video urls and displays or announces the titles"
 __module_author__      = "FichteFoll <fichtefoll2@googlemail.com>"
 
@@ -37,15 +45,39 @@ Usage:
 /YTT \002ANNOUNCE\002 [ LIST | [ADD | REMOVE] <channel> {<channel>} ] - Manage list of channels where video titles should be announced
 /YTT \002MUTE\002 [ LIST | [ADD | REMOVE] <channel> {<channel>} ] - Manage list of channels where video urls should be ignored
 /YTT \002KEY\002 [GET | SET <key>] - Get/Set the YouTube API key
+/YTT \002CACHE\002 [ STATS | CLEAR | TTL [<seconds>] ] - Manage the cache of video titles
 By default, YouTube Title will only print the video's title for you."""
 
-HELP_MAP = dict(zip(('get', 'announce', 'mute', 'key'),
+HELP_MAP = dict(zip(('get', 'announce', 'mute', 'key', 'cache'),
                     HELP_STR.splitlines()[1:-1]))
 
 PRINT_PREFIX = "*ytt*"
 
+BATCH_DELAY = 200  # in ms; time to collect video ids before querying the API
+POLL_INTERVAL = 50  # in ms; how often to check for finished API requests
+MAX_IDS_PER_REQUEST = 50  # limit of the videos API
+MAX_WORKERS = 2
+
+API_URL = "https://www.googleapis.com/youtube/v3/"
+REQUEST_TIMEOUT = (5, 10)  # in seconds; for connecting and reading
+RETRIES = 3  # for connection errors and HTTP statuses in RETRY_STATUSES
+RETRY_BACKOFF = 0.5  # in seconds; doubled for each retry
+RETRY_WAIT_MAX = 3  # in seconds; longest wait before a retry, also for Retry-After
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+CACHE_FILE = os.path.join(hexchat.get_info("configdir"), "youtube_title_cache.json")
+CACHE_SIZE = 5000  # number of remembered titles
+DEFAULT_CACHE_TTL = 24 * 60 * 60  # in seconds
+CACHE_SAVE_INTERVAL = 10 * 60  # in seconds
+
 # global
 prefs = None
+executor = None
+session = None
+cache = None
+pending = []  # (vids, title_handler, context) waiting for BATCH_DELAY
+in_flight = {}  # vid -> future of the request fetching it
+channel_lists = {'announce': frozenset(), 'mute': frozenset()}  # in-memory copy of prefs
 
 
 ###############################################################################
@@ -70,17 +102,86 @@ def print(*args, context=None, **kwargs):
 ###############################################################################
 # Other Functions
 
+class YouTubeAPIError(Exception):
+    pass
+
+
+class APIStats(object):
+    """Thread-safe counters for API requests.
+
+    Errors include failed attempts that were retried.
+    """
+
+    def __init__(self):
+        super(APIStats, self).__init__()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+    def record(self, duration, errors=0):
+        with self._lock:
+            self.requests += 1
+            self.errors += errors
+            self.total_time += duration
+            self.max_time = max(self.max_time, duration)
+
+    def counters(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'avg_ms': "{:.0f}".format(self.total_time * 1000 / (self.requests or 1)),
+                'max_ms': "{:.0f}".format(self.max_time * 1000),
+            }
+
+
+api_stats = APIStats()
+
+
+def make_session():
+    """Build a session that keeps connections alive and retries failed requests."""
+    options = dict(total=RETRIES, backoff_factor=RETRY_BACKOFF,
+                   status_forcelist=RETRY_STATUSES, allowed_methods=("GET",),
+                   raise_on_status=False)
+    try:
+        retry = Retry(backoff_max=RETRY_WAIT_MAX, retry_after_max=RETRY_WAIT_MAX, **options)
+    except TypeError:
+        # Older urllib3 can't cap Retry-After,
+        # which would block a worker for as long as the server asks
+        retry = Retry(respect_retry_after_header=False, **options)
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=MAX_WORKERS)
+    new_session = requests.Session()
+    new_session.mount("https://", adapter)
+    new_session.mount("http://", adapter)
+    return new_session
+
+
 def yt_api(path, **params):
-    params.setdefault('key', prefs.get('key'))
-    if not params['key']:
+    if not params.get('key'):
         raise TypeError("You must set an API key using `/ytt key set <key>`")
-    return requests.get("https://www.googleapis.com/youtube/v3/" + path,
-                        params=params)
+    start = time.perf_counter()
+    try:
+        response = session.get(API_URL + path, params=params, timeout=REQUEST_TIMEOUT)
+    except requests.exceptions.RequestException:
+        api_stats.record(time.perf_counter() - start, errors=1)
+        raise
+    retries = getattr(response.raw, 'retries', None)
+    retried = len(retries.history) if retries is not None else 0
+    api_stats.record(time.perf_counter() - start, errors=retried + (not response.ok))
+    return response
+
 
+def get_yt_titles(vids, key):
+    """Map video ids to titles, omitting videos that were not found.
 
-def get_yt_titles(vids):
+    Does not access hexchat's API
+    so that it can be run in a worker thread.
+    """
     # https://developers.google.com/youtube/v3/docs/videos/list
     req = yt_api('videos',
+                 key=key,
                  id=','.join(vids),
                  part="snippet",
                  fields="items(id,snippet(title))")
@@ -88,60 +189,191 @@ def get_yt_titles(vids):
     data = req.json()
 
     if 'error' in data:
-        print("Errors trying to fetch video information")
-        for error in data['error']['errors']:
-            print("  " + error['message'])
-        return []
-
-    mapping = {video['id']: video['snippet']['title']
-               for video in data['items']}
+        raise YouTubeAPIError("\n".join("  " + error['message']
+                                        for error in data['error']['errors']))
 
-    return [mapping.get(vid, "Video for %s not found" % vid)
-            for vid in vids]
+    return {video['id']: video['snippet']['title']
+            for video in data['items']}
 
 
-# These regular expressions have been simplified
+# This regular expression has been simplified
 # TODO: more accurate regex?
-normal = re.compile(r"(?:&|\?|/)v(?:=|/)([\w\-]{11})")
-short = re.compile(r"(?:(?:https?\://)?(?:\w+\.)?(?:youtube|youtu)(?:\.\w+){1,2}/)([\w\-]{11})")
+video_id_re = re.compile(r"(?:(?:&|\?|/)v(?:=|/)"
+                         r"|(?i:(?:https?\://)?(?:\w+\.)?(?:youtube|youtu)(?:\.\w+){1,2}/))"
+                         r"([\w\-]{11})")
 
 
 def find_ids(text):
-    """Find all (unique) video ids in a given text, sorted by start pos."""
-    ids = set()
-
-    for reg in (normal, short):
-        for m in reg.finditer(text):
-            ids.add((m.start(1), m.group(1)))
+    """Find all unique video ids in a given text, in order of appearance."""
+    # Most messages don't contain a link at all
+    if "youtu" not in text.lower():
+        return []
+    return list(dict.fromkeys(video_id_re.findall(text)))
+
+
+class TitleCache(object):
+    """LRU cache of video titles with a time-to-live, persisted as JSON."""
+
+    def __init__(self, path, ttl, max_size=CACHE_SIZE):
+        super(TitleCache, self).__init__()
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.requests = 0
+        self.requests_saved = 0
+        self._d = OrderedDict()  # vid -> (title, expiry time)
+
+    def get(self, vid):
+        item = self._d.get(vid)
+        if item is not None and item[1] < time.time():
+            del self._d[vid]
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._d.move_to_end(vid)
+        return item[0]
+
+    def put(self, vid, title):
+        self._d[vid] = (title, time.time() + self.ttl)
+        self._d.move_to_end(vid)
+        while len(self._d) > self.max_size:
+            self._d.popitem(last=False)
+        self.dirty = True
+
+    def clear(self):
+        self._d.clear()
+        self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            now = time.time()
+            self._d = OrderedDict((vid, (str(title), float(expiry)))
+                                  for vid, (title, expiry) in data
+                                  if float(expiry) > now)
+        except FileNotFoundError:
+            return
+        except (OSError, TypeError, ValueError, IndexError) as e:
+            print("Could not load title cache:\n%s" % e)
+
+    def save(self, userdata=None):
+        if self.dirty:
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(list(self._d.items()), f)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print("Could not save title cache:\n%s" % e)
+            else:
+                self.dirty = False
+        return True  # loopable
 
-    return [vid for (pos, vid) in sorted(ids, key=lambda x: x[0])]
+    def stats(self):
+        lookups = self.hits + self.misses
+        return ("{size} titles cached (TTL {ttl}s)\n"
+                "{hits} hits, {misses} misses ({rate:.1%} hit rate), "
+                "{dedup} deduplicated in-flight lookups\n"
+                "{requests} API requests made, {saved} saved"
+                .format(size=len(self._d), ttl=self.ttl, hits=self.hits, misses=self.misses,
+                        rate=self.hits / lookups if lookups else 0, dedup=self.deduplicated,
+                        requests=self.requests, saved=self.requests_saved))
 
 
-def say_yt_title(title):
+def say_yt_title(title, context):
     message = "\002Title:\002 " + title
+    context.command("say {message}".format(message=message))
 
-    # Delay our "say" because otherwise it will occur before we have actually
-    # sent the video url.
-    context = hexchat.get_context()
-    set_timeout(lambda: context.command("say {message}".format(message=message)))
 
-
-def print_yt_title(title):
+def print_yt_title(title, context):
     message = "\002Title:\002 " + title
-    # Same as in say_yt_title, except the print would otherwise be printed before
-    # the received message.
-    context = hexchat.get_context()
-    set_timeout(lambda: print(message, context=context))
+    print(message, context=context)
 
 
 def process_vids(vids, title_handler):
-    try:
-        titles = get_yt_titles(vids)
-    except (requests.exceptions.HTTPError, TypeError) as e:
-        print("Could not retrieve video title(s):\n%s" % e)
+    """Look up titles of `vids` in the background and pass them to `title_handler`.
+
+    Video ids from all calls within `BATCH_DELAY` are queried together.
+    `title_handler` is called from the main thread
+    with the title and the context that was active during this call.
+    """
+    if not pending:
+        set_timeout(flush_pending, BATCH_DELAY)
+    pending.append((vids, title_handler, hexchat.get_context()))
+
+
+def flush_pending():
+    global pending
+    batch, pending = pending, []
+
+    key = prefs.get('key')
+    if not key:
+        print("Could not retrieve video title(s):\n"
+              "You must set an API key using `/ytt key set <key>`")
+        return
+
+    vids = list(dict.fromkeys(vid for batch_vids, _, _ in batch for vid in batch_vids))
+    titles = {}
+    futures = {}  # vid -> future
+    missing = []
+    for vid in vids:
+        title = cache.get(vid)
+        if title is not None:
+            titles[vid] = title
+        elif vid in in_flight:
+            futures[vid] = in_flight[vid]
+            cache.deduplicated += 1
+        else:
+            missing.append(vid)
+
+    for i in range(0, len(missing), MAX_IDS_PER_REQUEST):
+        chunk = missing[i:i + MAX_IDS_PER_REQUEST]
+        future = executor.submit(get_yt_titles, chunk, key)
+        for vid in chunk:
+            futures[vid] = in_flight[vid] = future
+    request_count = -(-len(missing) // MAX_IDS_PER_REQUEST)
+    cache.requests += request_count
+    cache.requests_saved += -(-len(vids) // MAX_IDS_PER_REQUEST) - request_count
+
+    def poll_futures(userdata=None):
+        if not all(future.done() for future in futures.values()):
+            return True  # keep polling
+
+        errors = set()
+        for vid, future in futures.items():
+            if in_flight.get(vid) is future:
+                del in_flight[vid]
+            try:
+                title = future.result().get(vid)
+            except (requests.exceptions.RequestException, YouTubeAPIError) as e:
+                errors.add(str(e))
+                continue
+            if title is None:
+                # Not cached, the video may just not be public yet
+                titles[vid] = "Video for %s not found" % vid
+            else:
+                titles[vid] = title
+                cache.put(vid, title)
+        for error in errors:
+            print("Could not retrieve video title(s):\n%s" % error)
+
+        for batch_vids, title_handler, context in batch:
+            for vid in batch_vids:
+                if vid in titles:
+                    title_handler(titles[vid], context)
+        return False
+
+    if futures:
+        hexchat.hook_timer(POLL_INTERVAL, poll_futures)
     else:
-        for title in titles:
-            title_handler(title)
+        poll_futures()
 
 
 def manage_list_setting(name, action, items=[]):
@@ -168,24 +400,33 @@ def manage_list_setting(name, action, items=[]):
         print(HELP_MAP[name])
 
     prefs[name] = list_
+    load_channel_lists()
+
+
+def load_channel_lists():
+    """Copy the announce and mute lists from the prefs into `channel_lists`."""
+    for name in channel_lists:
+        channel_lists[name] = frozenset(prefs.get(name, ()))
 
 
 ###############################################################################
 # Entry Points
 
 def msg_cb(word, word_eol, userdata):
+    vids = find_ids(word[1])
+    if not vids:
+        return
+
     channel = hexchat.get_info('channel').lower()
 
-    if channel in prefs.get('mute', tuple()):
+    if channel in channel_lists['mute']:
         return
-    elif channel in prefs.get('announce', tuple()):
+    elif channel in channel_lists['announce']:
         callback = say_yt_title
     else:
         callback = print_yt_title
 
-    vids = find_ids(word[1])
-    if vids:
-        process_vids(vids, callback)
+    process_vids(vids, callback)
 
 
 def privmsg_cb(word, word_eol, userdata):
@@ -227,6 +468,20 @@ def yttcmd_cb(word, word_eol, userdata):
             print("Key set")
         else:
             print(HELP_MAP[sub_cmd])
+    elif sub_cmd == 'cache':
+        action = args[0].lower()
+        if action == 'stats':
+            print(cache.stats())
+        elif action == 'clear':
+            cache.clear()
+            print("Cache cleared")
+        elif action == 'ttl' and len(args) == 1:
+            print("Cache TTL: {}s".format(cache.ttl))
+        elif action == 'ttl' and len(args) == 2 and args[1].isdigit():
+            prefs['cache_ttl'] = cache.ttl = int(args[1])
+            print("Cache TTL set to {}s (applies to new entries)".format(cache.ttl))
+        else:
+            print(HELP_MAP[sub_cmd])
     elif sub_cmd in ('announce', 'mute'):
         action, *channels = args
         # lowercase the channels before passing to list handler
@@ -244,9 +499,11 @@ def yttcmd_cb(word, word_eol, userdata):
 def main():
     ###########################################################################
     # Manage Preferences
-    global prefs
+    global prefs, executor, cache, session
 
     prefs = JSONPluginPref(__module_name__)
+    executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+    session = make_session()
 
     if prefs.version is NotImplemented:
         print("There was an error retrieving the preferences' version.\n"
@@ -257,11 +514,13 @@ def main():
     if prefs.version is None:  # before 0.3.0
         # convert preferences to JSON storage
         bare_prefs = PluginPref(__module_name__, prefix_sep="_")
+        converted = {}
         for key, value in bare_prefs.items():
             if key in ('announce', 'mute'):
                 value = list(filter(None, value.split(",")))
-            prefs[key] = value
-            del bare_prefs[key]
+            converted[key] = value
+        prefs.update_many(converted)
+        bare_prefs.clear()
 
         prefs.version = (0, 3, 0)  # hardcode for further migrations
         print("Converted preference storage to 0.3.0")
@@ -271,19 +530,31 @@ def main():
 
     # Write current version at last
     prefs.version = versioninfo
+    load_channel_lists()
 
     ###########################################################################
     # Register Hooks
 
-    hexchat.hook_command("YTT", yttcmd_cb, help=HELP_STR)
+    cache = TitleCache(CACHE_FILE, prefs.get('cache_ttl', DEFAULT_CACHE_TTL))
+    cache.load()
+
+    hexchat.hook_unload(lambda userdata: executor.shutdown(wait=False))
+    hexchat.hook_unload(lambda userdata: session.close())
+    hexchat.hook_unload(cache.save)
+    hexchat.hook_timer(CACHE_SAVE_INTERVAL * 1000, cache.save)
+
+    hook_stats = HookStats(__module_name__)
+
+    hook_stats.add_counters("api", api_stats.counters)
+    hook_stats.hook_command("YTT", yttcmd_cb, help=HELP_STR)
 
     private_msg_events = ("Notice", "Private Message", "Private Action")
     for event in private_msg_events:
-        hexchat.hook_print(event, privmsg_cb)
+        hook_stats.hook_print(event, privmsg_cb)
 
     public_msg_events = ("Channel Message", "Action", "Your Message", "Your Action")
     for event in public_msg_events:
-        hexchat.hook_print(event, msg_cb)
+        hook_stats.hook_print(event, msg_cb)
 
     print(__module_name__, __module_version__, "loaded")
 